@@ -3,7 +3,7 @@
 # Imports...
 import gradio as gr
 from gradio import themes
-import re, os, json, pyperclip, yake, random, asyncio, queue, threading, asyncio, time
+import re, os, json, pyperclip, yake, random, asyncio, queue, threading, asyncio, time, shutil
 from pathlib import Path
 from datetime import datetime
 import tkinter as tk
@@ -24,13 +24,15 @@ from scripts.temporary import (
 )
 from scripts import utility
 from scripts.utility import (
-    delete_all_session_vectorstores, create_session_vectorstore, web_search, get_saved_sessions,
+    delete_all_session_vectorstores, create_session_vectorstore, web_search,
     load_session_history, save_session_history, load_and_chunk_documents,
     get_available_gpus, save_config, filter_operational_content
 )
 from scripts.models import (
     get_response_stream, get_available_models, unload_models, get_model_settings,
-    context_injector, inspect_model, load_models
+    context_injector, inspect_model, load_models, conversation_cache, inference_worker,
+    cancel_generation, clean_content, generation_stats, prefill_prompt,
+    start_context_stages, collect_context_stages
 )
 from langchain_core.documents import Document
 
@@ -104,28 +106,42 @@ def process_attach_files(files, attached_files, models_loaded):
 
 def process_vector_files(files, vector_files, models_loaded):
     if not models_loaded:
-        return "Error: Load model first.", vector_files
+        yield "Error: Load model first.", vector_files
+        return
+    if not context_injector.ready.is_set():
+        yield "Waiting for the session restore to finish...", vector_files
+        if not context_injector.wait_until_ready(temporary.RESTORE_WAIT_TIMEOUT):
+            yield "Error: Session restore still running, try again shortly.", vector_files
+            return
+    # The restore installs the session's files, so the state passed in may predate it
+    vector_files = list(temporary.session_vector_files)
+    if not temporary.current_session_id:
+        temporary.current_session_id = utility.generate_session_id()
     new_files = [f for f in files if os.path.isfile(f) and f not in vector_files]
     for file in new_files:
         dest = Path(temporary.TEMP_DIR) / f"session_{temporary.current_session_id}" / "vector" / Path(file).name
         dest.parent.mkdir(parents=True, exist_ok=True)
+        if dest.exists():
+            os.unlink(dest)  # Write a new file rather than through a restored one
         shutil.copy(file, dest)
         vector_files.append(str(dest))
+    temporary.session_vector_files = vector_files
     
-    # Incremental update to vectorstore
-    if context_injector.session_vectorstore is None:
-        session_vectorstore = utility.create_session_vectorstore(vector_files, temporary.current_session_id)
-    else:
-        new_docs = utility.load_and_chunk_documents(new_files)
-        if new_docs:
-            context_injector.session_vectorstore.add_documents(new_docs)
-            session_vectorstore = context_injector.session_vectorstore
-        else:
-            session_vectorstore = context_injector.session_vectorstore
+    # Incremental update to vectorstore, only the new files are chunked and embedded
+    session_vectorstore = context_injector.session_vectorstore
+    ingest_files = vector_files if session_vectorstore is None else new_files
+    status = "No new vector files."
+    try:
+        for status, session_vectorstore in utility.stream_session_vectorstore(
+            ingest_files, temporary.current_session_id, vectorstore=session_vectorstore
+        ):
+            yield status, vector_files
+    except Exception as e:
+        status = f"Error processing vector files: {e}"
+        print(status)
     
     context_injector.set_session_vectorstore(session_vectorstore)
-    temporary.session_vector_files = vector_files
-    return f"Processed {len(new_files)} vector files.", vector_files
+    yield f"Processed {len(new_files)} vector files. {status}", vector_files
 
 def update_config_settings(ctx, batch, temp, repeat, vram, gpu, cpu, model):
     temporary.CONTEXT_SIZE = int(ctx)
@@ -340,6 +356,7 @@ def start_new_session(models_loaded):
     temporary.current_session_id = None
     temporary.session_label = ""
     temporary.SESSION_ACTIVE = True
+    utility.cancel_session_restore()
     context_injector.set_session_vectorstore(None)  # Clear session vectorstore
     return (
         [],                                # conversation_components["session_log"]
@@ -352,16 +369,53 @@ def start_new_session(models_loaded):
     )
 
 def load_session_by_index(index):
-    sessions = utility.get_saved_sessions()
+    sessions = temporary.session_slot_ids
     if index < len(sessions):
-        session_file = sessions[index]
-        session_id, label, history, attached_files, vector_files = utility.load_session_history(Path(HISTORY_DIR) / session_file)
+        session_id, label, history, attached_files, vector_files = utility.load_session(sessions[index], defer_files=True)
         temporary.current_session_id = session_id
         temporary.session_label = label
         temporary.SESSION_ACTIVE = True
-        return history, attached_files, vector_files, f"Loaded session: {label}"
+        utility.start_session_restore(session_id, attached_files, vector_files)
+        return history, [], [], f"Loaded session: {label}, restoring files..."
     return [], [], [], "No session to load"
 
+def wait_for_session_restore():
+    """Stream restore progress, then hand the hydrated file lists to the UI states."""
+    while not context_injector.ready.wait(0.25):
+        yield gr.update(), gr.update(), temporary.session_restore_status
+    yield temporary.session_attached_files, temporary.session_vector_files, temporary.session_restore_status
+
+def take_back_last_turn(session_log, phase, regenerate=False):
+    """
+    Remove the last user/assistant exchange and return its input for regenerating or editing.
+
+    Resending forks the conversation at that message; the prefix-tree state cache restores
+    the evaluated prompt up to the branch point, so only the new tokens are processed.
+    """
+    if phase != "waiting_for_input":
+        raise gr.Error("Wait for the current response to finish.")
+    if len(session_log) < 2 or session_log[-2]['role'] != 'user':
+        raise gr.Error("No previous message to regenerate or edit.")
+    user_text = clean_content('user', session_log[-2]['content'])
+    user_text = re.sub(r'\n\nAttached: [^\n]*$', '', user_text)
+    session_log = session_log[:-2]
+    if regenerate:
+        return session_log, gr.update(value=user_text), "Regenerating response..."
+    return session_log, gr.update(value=user_text, interactive=True), "Edit the message and send it again."
+
+def export_current_session():
+    """Write the current session to HISTORY_DIR in the single-file JSON format."""
+    if not temporary.current_session_id:
+        return "No session to export."
+    try:
+        export_path = utility.export_session_json(temporary.current_session_id)
+        return f"Session exported to {export_path}"
+    except FileNotFoundError:
+        return "Session has not been saved yet, send a message first."
+    except Exception as e:
+        print(f"Error exporting session: {e}")
+        return f"Error exporting session: {e}"
+
 def copy_last_response(session_log):
     if session_log and session_log[-1]['role'] == 'assistant':
         response = session_log[-1]['content']
@@ -432,20 +486,17 @@ def filter_operational_content(text):
         text = re.sub(pattern, '', text, flags=re.DOTALL)
     return text.strip()
 
-def update_session_buttons():
-    sessions = utility.get_saved_sessions()[:temporary.MAX_HISTORY_SLOTS]
+def update_session_buttons(query=""):
+    sessions = utility.get_session_entries(query, temporary.MAX_HISTORY_SLOTS)
+    temporary.session_slot_ids = [entry["session_id"] for entry in sessions]
     button_updates = []
     for i in range(temporary.MAX_POSSIBLE_HISTORY_SLOTS):
         if i < len(sessions):
-            session_path = Path(HISTORY_DIR) / sessions[i]
             try:
-                stat = session_path.stat()
-                update_time = stat.st_mtime if stat.st_mtime else stat.st_ctime
-                formatted_time = datetime.fromtimestamp(update_time).strftime("%Y-%m-%d %H:%M")
-                session_id, label, history, attached_files, vector_files = utility.load_session_history(session_path)
-                btn_label = f"{formatted_time} - {label}"
+                formatted_time = datetime.fromtimestamp(sessions[i]["mtime"]).strftime("%Y-%m-%d %H:%M")
+                btn_label = f"{formatted_time} - {sessions[i]['label']}"
             except Exception as e:
-                print(f"Error loading session {session_path}: {e}")
+                print(f"Error reading session entry {sessions[i].get('session_id')}: {e}")
                 btn_label = f"Session {i+1}"
             visible = True
         else:
@@ -466,7 +517,7 @@ def update_action_button(phase):
     if phase == "waiting_for_input":
         return gr.update(value="Send Input", variant="secondary", elem_classes=["send-button-green"], interactive=True)
     elif phase == "afterthought_countdown":
-        return gr.update(value="Cancel Submission", variant="secondary", elem_classes=["send-button-orange"], interactive=False)
+        return gr.update(value="Cancel Submission", variant="secondary", elem_classes=["send-button-orange"], interactive=True)
     elif phase == "generating_response":
         return gr.update(value="Wait For Response", variant="secondary", elem_classes=["send-button-red"], interactive=True)  # Interactive for cancellation
     elif phase == "speaking":
@@ -474,10 +525,23 @@ def update_action_button(phase):
     else:
         return gr.update(value="Unknown Phase", variant="secondary", elem_classes=["send-button-green"], interactive=False)
 
+def request_cancel(phase):
+    """Signal the running turn to stop; returns the cancel_flag for this click."""
+    if phase in ("afterthought_countdown", "generating_response"):
+        cancel_generation.set()
+        print(f"Debug: Cancel requested during {phase}")
+        return True
+    return False
+
 # Async Converstation Interface
 async def conversation_interface(user_input, session_log, tot_enabled, loaded_files, enable_think,
                                  is_reasoning_model, cancel_flag, web_search_enabled,
                                  models_loaded, interaction_phase, speak_enabled, llm_state, models_loaded_state):
+    if cancel_flag:
+        # This click was a cancel; request_cancel already signalled the running turn
+        yield gr.update(), gr.update(), gr.update(), False, gr.update(), gr.update(), gr.update(), gr.update(), gr.update(), gr.update(), gr.update()
+        return
+
     if not models_loaded_state:
         yield session_log, "Please load a model first.", update_action_button(interaction_phase), cancel_flag, loaded_files, interaction_phase, gr.update(), gr.update(), gr.update(), gr.update(), gr.update()
         return
@@ -487,22 +551,30 @@ async def conversation_interface(user_input, session_log, tot_enabled, loaded_fi
         return
 
     print("Debug: Starting conversation_interface with input:", user_input)
+    cancel_generation.clear()
+    if not temporary.current_session_id:
+        temporary.current_session_id = utility.generate_session_id()  # So the first turn's KV state can be saved
 
     original_input = user_input
     if temporary.session_attached_files:
-        for file in temporary.session_attached_files:
-            try:
-                with open(file, 'r', encoding='utf-8') as f:
-                    file_content = f.read()
-                user_input += f"\n\nAttached File Content ({Path(file).name}):\n{file_content}"
-            except Exception as e:
-                print(f"Error reading attached file {file}: {e}")
+        # File contents are injected per turn by the context budget; the log only names them
+        user_input += "\n\nAttached: " + ", ".join(Path(file).name for file in temporary.session_attached_files)
 
     session_log.append({'role': 'user', 'content': f"User:\n{user_input}"})
     session_log.append({'role': 'assistant', 'content': "Working on response..."})
     interaction_phase = "afterthought_countdown"
     yield session_log, "Processing...", update_action_button(interaction_phase), cancel_flag, loaded_files, interaction_phase, gr.update(interactive=False), gr.update(), gr.update(), gr.update(), gr.update()
 
+    # Search, retrieval and attachment reads run side by side from here, overlapping the countdown
+    stages = start_context_stages(original_input, temporary.session_attached_files, web_search_enabled)
+    settings = get_model_settings(temporary.MODEL_NAME)
+    if temporary.COUNTDOWN_PREFILL:
+        # Evaluate the prompt while the countdown runs, so prefill is hidden instead of added
+        prefill_prompt(
+            session_log, settings, llm_state, cancel_generation, stages=stages,
+            disable_think=not enable_think, tot_enabled=tot_enabled, web_search_enabled=web_search_enabled
+        )
+
     input_length = len(original_input.strip())
     countdown_seconds = 1 if input_length <= 25 else 3 if input_length <= 100 else 5
     progress_indicators = ["⠋", "⠙", "⠹", "⠸", "⠼", "⠴", "⠦", "⠧", "⠇", "⠏"]
@@ -511,99 +583,98 @@ async def conversation_interface(user_input, session_log, tot_enabled, loaded_fi
         current_progress = random.choice(progress_indicators)
         yield session_log, f"{current_progress} Afterthought countdown... {i}s", update_action_button(interaction_phase), cancel_flag, loaded_files, interaction_phase, gr.update(), gr.update(), gr.update(), gr.update(), gr.update()
         await asyncio.sleep(1)
-        if cancel_flag:
-            session_log.pop()
+        if cancel_generation.is_set():
+            del session_log[-2:]
             interaction_phase = "waiting_for_input"
             yield session_log, "Input cancelled.", update_action_button(interaction_phase), False, loaded_files, interaction_phase, gr.update(interactive=True, value=original_input), gr.update(), gr.update(), gr.update(), gr.update()
             return
 
     prefix = "AI-Chat:"
     interaction_phase = "generating_response"
-    settings = get_model_settings(temporary.MODEL_NAME)
 
-    search_results = None
+    yield session_log, "🔍 Performing web search..." if web_search_enabled else "Gathering context...", update_action_button(interaction_phase), cancel_flag, loaded_files, interaction_phase, gr.update(), gr.update(), gr.update(), gr.update(), gr.update()
+    context = await asyncio.to_thread(collect_context_stages, stages)
+    search_results = context.get("search")
     if web_search_enabled:
-        yield session_log, "🔍 Performing web search...", update_action_button(interaction_phase), cancel_flag, loaded_files, interaction_phase, gr.update(), gr.update(), gr.update(), gr.update(), gr.update()
-        search_results = await asyncio.to_thread(utility.web_search, user_input)
         yield session_log, "✅ Web search completed." if search_results else "⚠️ No web results.", update_action_button(interaction_phase), cancel_flag, loaded_files, interaction_phase, gr.update(), gr.update(), gr.update(), gr.update(), gr.update()
 
-    q = queue.Queue()
-    cancel_event = threading.Event()
+    cancel_event = cancel_generation
     final_answer = []
     progress_blocks = ""
 
-    def run_generator():
-        try:
-            for chunk in get_response_stream(
-                session_log,
-                settings=settings,
-                disable_think=not enable_think,
-                tot_enabled=tot_enabled,
-                web_search_enabled=web_search_enabled,
-                search_results=search_results,
-                cancel_event=cancel_event,
-                llm_state=llm_state,
-                models_loaded_state=models_loaded_state
-            ):
-                q.put(chunk)
-            q.put(None)
-        except Exception as e:
-            q.put(f"Error: {str(e)}")
-
-    print("Debug: Starting generator thread")
-    thread = threading.Thread(target=run_generator, daemon=True)
-    thread.start()
-
-    while True:
-        print("Debug: Waiting for chunk")
-        chunk = await asyncio.to_thread(q.get)
-        print(f"Debug: Received chunk: {chunk}")
-        if chunk is None:
-            break
-        if cancel_flag:
-            cancel_event.set()
-            session_log[-1]['content'] = "Generation cancelled."
-            break
-        if chunk == "<CANCELLED>":
-            session_log[-1]['content'] = "Generation cancelled."
-            break
-        if isinstance(chunk, str) and chunk.startswith("Error:"):
-            session_log[-1]['content'] = chunk
-            yield session_log, f"⚠️ {chunk}", update_action_button("waiting_for_input"), False, loaded_files, "waiting_for_input", gr.update(interactive=True), gr.update(), gr.update(), gr.update(), gr.update()
-            return
+    print("Debug: Submitting generation to inference worker")
+    channel = inference_worker.submit(
+        lambda: get_response_stream(
+            session_log,
+            settings=settings,
+            disable_think=not enable_think,
+            tot_enabled=tot_enabled,
+            web_search_enabled=web_search_enabled,
+            search_results=search_results,
+            cancel_event=cancel_event,
+            llm_state=llm_state,
+            models_loaded_state=models_loaded_state,
+            rag_chunks=context.get("rag"),
+            attachments=context.get("attachments")
+        ),
+        cancel_event
+    )
 
-        if tot_enabled:
-            if chunk == "<TOT_PROGRESS>":
-                progress_blocks += "█"
-                yield session_log, f"{progress_blocks}", update_action_button(interaction_phase), cancel_flag, loaded_files, interaction_phase, gr.update(), gr.update(), gr.update(), gr.update(), gr.update()
-            elif chunk == "<TOT_ANSWER_START>":
-                yield session_log, "Streaming Response...", update_action_button(interaction_phase), cancel_flag, loaded_files, interaction_phase, gr.update(), gr.update(), gr.update(), gr.update(), gr.update()
-            else:
-                final_answer.append(chunk)
-                display = " ".join(final_answer).strip()
-                session_log[-1]['content'] = f"{prefix}\n{display}"
-                yield session_log, f"{random.choice(progress_indicators)} Streaming Response...", update_action_button(interaction_phase), cancel_flag, loaded_files, interaction_phase, gr.update(), gr.update(), gr.update(), gr.update(), gr.update()
-        else:
-            if chunk == "<THINKING_PROGRESS>":
+    # Text is appended to `display` as it arrives, but pushed to the UI at most once per
+    # frame (or every STREAM_FRAME_TOKENS pieces), so token streaming stays cheap for Gradio
+    frame_seconds = temporary.STREAM_FRAME_MS / 1000
+    display = ""
+    pending_pieces = 0
+    last_push = time.monotonic()
+    done = False
+    while not done:
+        try:
+            chunks = await asyncio.wait_for(channel.get(), frame_seconds)
+        except asyncio.TimeoutError:
+            chunks = []
+        while not channel.empty():
+            chunks += channel.get_nowait()
+
+        for chunk in chunks:
+            if chunk is None:
+                done = True
+                break
+            if chunk == "<CANCELLED>":
+                session_log[-1]['content'] = "Generation cancelled."
+                done = True
+                break
+            if isinstance(chunk, str) and chunk.startswith("Error:"):
+                session_log[-1]['content'] = chunk
+                yield session_log, f"⚠️ {chunk}", update_action_button("waiting_for_input"), False, loaded_files, "waiting_for_input", gr.update(interactive=True), gr.update(), gr.update(), gr.update(), gr.update()
+                return
+
+            if chunk in ("<TOT_PROGRESS>", "<THINKING_PROGRESS>"):
                 progress_blocks += "█"
                 yield session_log, f"{progress_blocks}", update_action_button(interaction_phase), cancel_flag, loaded_files, interaction_phase, gr.update(), gr.update(), gr.update(), gr.update(), gr.update()
-            elif chunk == "<THINKING_DONE>":
+            elif chunk in ("<TOT_ANSWER_START>", "<THINKING_DONE>"):
                 yield session_log, "Streaming Response...", update_action_button(interaction_phase), cancel_flag, loaded_files, interaction_phase, gr.update(), gr.update(), gr.update(), gr.update(), gr.update()
             else:
                 final_answer.append(chunk)
-                display = " ".join(final_answer).strip()
-                session_log[-1]['content'] = f"{prefix}\n{display}"
-                yield session_log, f"{random.choice(progress_indicators)} Streaming Response...", update_action_button(interaction_phase), cancel_flag, loaded_files, interaction_phase, gr.update(), gr.update(), gr.update(), gr.update(), gr.update()
+                display += chunk
+                pending_pieces += 1
 
-        await asyncio.sleep(0.02)
+        if pending_pieces and not done and (
+            pending_pieces >= temporary.STREAM_FRAME_TOKENS or time.monotonic() - last_push >= frame_seconds
+        ):
+            session_log[-1]['content'] = f"{prefix}\n{display.strip()}"
+            yield session_log, f"{random.choice(progress_indicators)} Streaming Response...", update_action_button(interaction_phase), cancel_flag, loaded_files, interaction_phase, gr.update(), gr.update(), gr.update(), gr.update(), gr.update()
+            pending_pieces = 0
+            last_push = time.monotonic()
 
     if final_answer:
         final_content = "".join(final_answer).strip()
         session_log[-1]['content'] = filter_operational_content(f"{prefix}\n{final_content}")
-        utility.save_session_history(session_log, temporary.session_attached_files, temporary.session_vector_files)
+        conversation_cache.remember(session_log[-1]['content'])
+        await asyncio.to_thread(utility.save_session_history, session_log)
     else:
         session_log[-1]['content'] = f"{prefix}\n<answer>\n(Empty response)</answer>"
-    yield session_log, "✅ Response ready", update_action_button("waiting_for_input"), False, loaded_files, "waiting_for_input", gr.update(interactive=True), gr.update(), gr.update(), gr.update(), gr.update()
+    ready_status = f"✅ Response ready ({generation_stats['summary']})" if "summary" in generation_stats else "✅ Response ready"
+    yield session_log, ready_status, update_action_button("waiting_for_input"), False, loaded_files, "waiting_for_input", gr.update(interactive=True), gr.update(), gr.update(), gr.update(), gr.update()
 
 # Core Gradio Interface    
 def launch_interface():
@@ -695,6 +766,13 @@ def launch_interface():
                             ) for _ in range(temporary.MAX_POSSIBLE_ATTACH_SLOTS)]
                         with gr.Group(visible=True) as history_slots_group:
                             start_new_session_btn = gr.Button("Start New Session...", variant="secondary")
+                            export_session_btn = gr.Button("Export Session (JSON)", variant="huggingface")
+                            session_search = gr.Textbox(
+                                placeholder="Search History...",
+                                show_label=False,
+                                lines=1,
+                                elem_classes=["clean-elements"]
+                            )
                             buttons = dict(
                                 session=[gr.Button(
                                     f"History Slot {i+1}",
@@ -773,6 +851,7 @@ def launch_interface():
                                             type="messages"
                                         )
                                     with gr.Row(elem_classes=["clean-elements"]):
+                                        action_buttons["regenerate"] = gr.Button("Regenerate", variant="huggingface", scale=1)
                                         action_buttons["edit_previous"] = gr.Button("Edit Previous", variant="huggingface", scale=1)
                                         action_buttons["copy_response"] = gr.Button("Copy Output", variant="huggingface", scale=1)
 
@@ -854,6 +933,19 @@ def launch_interface():
                             temp=gr.Dropdown(choices=temporary.TEMP_OPTIONS, label="Temperature (Creativity)", value=temporary.TEMPERATURE, scale=5),
                             repeat=gr.Dropdown(choices=temporary.REPEAT_OPTIONS, label="Repeat Penalty (Restraint)", value=temporary.REPEAT_PENALTY, scale=5),
                         )
+                    with gr.Row(elem_classes=["clean-elements"]):
+                        draft_choices = ["None"] + [m for m in available_models if m.endswith(".gguf")]
+                        config_components.update(
+                            speculative_mode=gr.Dropdown(choices=temporary.SPECULATIVE_OPTIONS, label="Speculative Decoding", value=temporary.SPECULATIVE_MODE, scale=5),
+                            draft_model=gr.Dropdown(
+                                choices=draft_choices,
+                                label="Draft Model (Same Vocabulary)",
+                                value=temporary.DRAFT_MODEL_NAME if temporary.DRAFT_MODEL_NAME in draft_choices else "None",
+                                scale=10
+                            ),
+                            speculative_tokens=gr.Dropdown(choices=temporary.SPECULATIVE_TOKEN_OPTIONS, label="Draft Tokens", value=temporary.SPECULATIVE_TOKENS, scale=5),
+                            generation_timeout=gr.Dropdown(choices=temporary.GENERATION_TIMEOUT_OPTIONS, label="Generation Timeout (Seconds, 0 Off)", value=temporary.GENERATION_TIMEOUT, scale=5),
+                        )
                     with gr.Row(elem_classes=["clean-elements"]):
                         config_components.update(
                             browse=gr.Button("Browse", variant="secondary"), 
@@ -869,7 +961,11 @@ def launch_interface():
                             max_history_slots=gr.Dropdown(choices=temporary.HISTORY_SLOT_OPTIONS, label="Max History Slots", value=temporary.MAX_HISTORY_SLOTS, scale=5),
                             session_log_height=gr.Dropdown(choices=temporary.SESSION_LOG_HEIGHT_OPTIONS, label="Session Log Height", value=temporary.SESSION_LOG_HEIGHT, scale=5),
                             input_lines=gr.Dropdown(choices=temporary.INPUT_LINES_OPTIONS, label="Input Lines", value=temporary.INPUT_LINES, scale=5),
-                            max_attach_slots=gr.Dropdown(choices=temporary.ATTACH_SLOT_OPTIONS, label="Max Attach Slots", value=temporary.MAX_ATTACH_SLOTS, scale=5)
+                            max_attach_slots=gr.Dropdown(choices=temporary.ATTACH_SLOT_OPTIONS, label="Max Attach Slots", value=temporary.MAX_ATTACH_SLOTS, scale=5),
+                            vector_index_type=gr.Dropdown(choices=temporary.VECTOR_INDEX_OPTIONS, label="Vector Index Type", value=temporary.VECTOR_INDEX_TYPE, scale=5),
+                            session_store=gr.Dropdown(choices=temporary.SESSION_STORE_OPTIONS, label="Session Store", value=temporary.SESSION_STORE, scale=5),
+                            attach_inject_mode=gr.Dropdown(choices=temporary.ATTACH_INJECT_OPTIONS, label="Attachment Injection", value=temporary.ATTACH_INJECT_MODE, scale=5),
+                            stream_mode=gr.Dropdown(choices=temporary.STREAM_MODE_OPTIONS, label="Stream Mode", value=temporary.STREAM_MODE, scale=5)
                         )
                     with gr.Row(elem_classes=["clean-elements"]):
                         gr.Markdown("Critical Actions...")
@@ -928,46 +1024,75 @@ def launch_interface():
             outputs=[states["attached_files"], states["vector_files"]]
         )
 
+        export_session_btn.click(
+            fn=export_current_session,
+            inputs=[],
+            outputs=[status_text]
+        )
+
+        conversation_inputs = [
+            conversation_components["user_input"],
+            conversation_components["session_log"],
+            switches["tot"],
+            states["attached_files"],
+            switches["enable_think"],
+            states["is_reasoning_model"],
+            states["cancel_flag"],
+            switches["web_search"],
+            states["models_loaded"],
+            states["interaction_phase"],
+            switches["speak"],
+            states["llm"],
+            states["models_loaded"]
+        ]
+        conversation_outputs = [
+            conversation_components["session_log"],
+            status_text,
+            action_buttons["action"],
+            states["cancel_flag"],
+            states["attached_files"],
+            states["interaction_phase"],
+            conversation_components["user_input"],
+            switches["web_search"],
+            switches["tot"],
+            switches["enable_think"],
+            switches["speak"]
+        ]
+
         action_buttons["action"].click(
-            fn=lambda phase: True if phase == "generating_response" else False,
+            fn=request_cancel,
             inputs=[states["interaction_phase"]],
             outputs=[states["cancel_flag"]]
         ).then(
             fn=conversation_interface,
-            inputs=[
-                conversation_components["user_input"],
-                conversation_components["session_log"],
-                switches["tot"],
-                states["attached_files"],
-                switches["enable_think"],
-                states["is_reasoning_model"],
-                states["cancel_flag"],
-                switches["web_search"],
-                states["models_loaded"],
-                states["interaction_phase"],
-                switches["speak"],
-                states["llm"],
-                states["models_loaded"]
-            ],
-            outputs=[
-                conversation_components["session_log"],
-                status_text,
-                action_buttons["action"],
-                states["cancel_flag"],
-                states["attached_files"],
-                states["interaction_phase"],
-                conversation_components["user_input"],
-                switches["web_search"],
-                switches["tot"],
-                switches["enable_think"],
-                switches["speak"]
-            ]
+            inputs=conversation_inputs,
+            outputs=conversation_outputs
+        ).then(
+            fn=update_session_buttons,
+            inputs=[],
+            outputs=buttons["session"]
+        )
+
+        action_buttons["regenerate"].click(
+            fn=lambda log, phase: take_back_last_turn(log, phase, regenerate=True),
+            inputs=[conversation_components["session_log"], states["interaction_phase"]],
+            outputs=[conversation_components["session_log"], conversation_components["user_input"], status_text]
+        ).success(
+            fn=conversation_interface,
+            inputs=conversation_inputs,
+            outputs=conversation_outputs
         ).then(
             fn=update_session_buttons,
             inputs=[],
             outputs=buttons["session"]
         )
 
+        action_buttons["edit_previous"].click(
+            fn=lambda log, phase: take_back_last_turn(log, phase, regenerate=False),
+            inputs=[conversation_components["session_log"], states["interaction_phase"]],
+            outputs=[conversation_components["session_log"], conversation_components["user_input"], status_text]
+        )
+
         action_buttons["copy_response"].click(
             fn=copy_last_response,
             inputs=[conversation_components["session_log"]],
@@ -1013,14 +1138,14 @@ def launch_interface():
                 fn=load_session_by_index,
                 inputs=[gr.State(value=i)],
                 outputs=[conversation_components["session_log"], states["attached_files"], states["vector_files"], status_text]
-            ).then(
-                fn=lambda: context_injector.load_session_vectorstore(temporary.current_session_id),
-                inputs=[],
-                outputs=[]
             ).then(
                 fn=update_session_buttons,
                 inputs=[],
                 outputs=buttons["session"]
+            ).then(
+                fn=wait_for_session_restore,
+                inputs=[],
+                outputs=[states["attached_files"], states["vector_files"], status_text]
             ).then(
                 fn=lambda files: update_file_slot_ui(files, True),
                 inputs=[states["attached_files"]],
@@ -1151,6 +1276,64 @@ def launch_interface():
             outputs=buttons["session"]
         )
 
+        custom_components["vector_index_type"].change(
+            fn=lambda t: (setattr(temporary, "VECTOR_INDEX_TYPE", t), f"Vector index type set to {t}, applied on next vector upload.")[1],
+            inputs=[custom_components["vector_index_type"]],
+            outputs=[status_text]
+        )
+
+        custom_components["session_store"].change(
+            fn=lambda t: (setattr(temporary, "SESSION_STORE", t), f"Session store set to {t}.")[1],
+            inputs=[custom_components["session_store"]],
+            outputs=[status_text]
+        ).then(
+            fn=update_session_buttons,
+            inputs=[],
+            outputs=buttons["session"]
+        )
+
+        custom_components["attach_inject_mode"].change(
+            fn=lambda m: (setattr(temporary, "ATTACH_INJECT_MODE", m), f"Attachment injection set to {m}.")[1],
+            inputs=[custom_components["attach_inject_mode"]],
+            outputs=[status_text]
+        )
+
+        config_components["speculative_mode"].change(
+            fn=lambda m: (setattr(temporary, "SPECULATIVE_MODE", m), f"Speculative decoding set to {m}, applies on next model load.")[1],
+            inputs=[config_components["speculative_mode"]],
+            outputs=[status_text]
+        )
+
+        config_components["draft_model"].change(
+            fn=lambda m: (setattr(temporary, "DRAFT_MODEL_NAME", m), f"Draft model set to {m}, applies on next model load.")[1],
+            inputs=[config_components["draft_model"]],
+            outputs=[status_text]
+        )
+
+        config_components["speculative_tokens"].change(
+            fn=lambda n: (setattr(temporary, "SPECULATIVE_TOKENS", int(n)), f"Draft tokens set to {n}, applies on next model load.")[1],
+            inputs=[config_components["speculative_tokens"]],
+            outputs=[status_text]
+        )
+
+        config_components["generation_timeout"].change(
+            fn=lambda t: (setattr(temporary, "GENERATION_TIMEOUT", int(t)), f"Generation timeout set to {t}s." if int(t) else "Generation timeout off.")[1],
+            inputs=[config_components["generation_timeout"]],
+            outputs=[status_text]
+        )
+
+        custom_components["stream_mode"].change(
+            fn=lambda m: (setattr(temporary, "STREAM_MODE", m), f"Stream mode set to {m}.")[1],
+            inputs=[custom_components["stream_mode"]],
+            outputs=[status_text]
+        )
+
+        session_search.submit(
+            fn=update_session_buttons,
+            inputs=[session_search],
+            outputs=buttons["session"]
+        )
+
         custom_components["max_attach_slots"].change(
             fn=lambda s: setattr(temporary, "MAX_ATTACH_SLOTS", s),
             inputs=[custom_components["max_attach_slots"]],
@@ -1,12 +1,16 @@
 # Script: `.\scripts\models.py`
 
 # Imports...
-import time, re
+import time, re, mmap, struct, json, os, threading, hashlib, shutil, asyncio, queue, pickle
+import numpy as np
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeoutError
 from pathlib import Path
 import gradio as gr
 from scripts.prompts import get_system_message, get_reasoning_instruction, get_tot_instruction
 from langchain_community.vectorstores import FAISS
 from langchain_huggingface import HuggingFaceEmbeddings
+from langchain_core.embeddings import Embeddings
 from sentence_transformers import SentenceTransformer
 import scripts.temporary as temporary  # Import module instead of specific variables
 from scripts.prompts import prompt_templates
@@ -16,6 +20,56 @@ from scripts.temporary import (
     MODEL_NAME, REPEAT_PENALTY, TEMPERATURE, MODELS_LOADED
 )
 
+# GGUF Header Constants
+GGUF_TYPE_BOOL = 7
+GGUF_TYPE_STRING = 8
+GGUF_TYPE_ARRAY = 9
+GGUF_SCALAR_FORMATS = {
+    0: "B", 1: "b", 2: "H", 3: "h", 4: "I", 5: "i",
+    6: "f", 7: "?", 10: "Q", 11: "q", 12: "d"
+}
+GGUF_ARRAY_LIMIT = 64  # Arrays longer than this (vocab, merges) are skipped
+GGUF_FILE_TYPES = {
+    0: "F32", 1: "F16", 2: "Q4_0", 3: "Q4_1", 7: "Q8_0", 8: "Q5_0", 9: "Q5_1",
+    10: "Q2_K", 11: "Q3_K_S", 12: "Q3_K_M", 13: "Q3_K_L", 14: "Q4_K_S", 15: "Q4_K_M",
+    16: "Q5_K_S", 17: "Q5_K_M", 18: "Q6_K", 19: "IQ2_XXS", 20: "IQ2_XS", 21: "Q2_K_S",
+    22: "IQ3_XS", 23: "IQ3_XXS", 24: "IQ1_S", 25: "IQ4_NL", 26: "IQ3_S", 27: "IQ3_M",
+    28: "IQ2_S", 29: "IQ2_M", 30: "IQ4_XS", 31: "IQ1_M", 32: "BF16", 36: "TQ1_0", 37: "TQ2_0"
+}
+
+# Model Info Cache
+model_info_cache = None
+model_info_lock = threading.Lock()
+
+# Serializes every evaluation on the loaded model (warm-up, chat, summaries)
+llm_lock = threading.RLock()
+
+# Set by the cancel button; checked by the sampler on every decode step of the running generation
+cancel_generation = threading.Event()
+
+# Session whose tokens the loaded model's KV cache currently holds, and the lock for state files
+kv_state_session = None
+kv_state_lock = threading.Lock()
+
+# Newest unwritten state snapshot per session, drained by a single writer thread
+kv_write_pending = {}
+kv_write_lock = threading.Lock()
+kv_write_ready = threading.Event()
+kv_writer_thread = None
+
+# Decode throughput and speculative acceptance of the last completed generation
+generation_stats = {}
+
+# Incremented per countdown prefill and when generation takes the model, so a stale prefill is skipped
+prefill_generation = 0
+
+# Runs each turn's web search, retrieval and attachment reads side by side
+context_executor = ThreadPoolExecutor(max_workers=6, thread_name_prefix="turn-context")
+
+# Shared Embedding Model
+embedding_model = None
+embedding_lock = threading.Lock()
+
 # Classes...
 class ContextInjector:
     def __init__(self):
@@ -23,6 +77,9 @@ class ContextInjector:
         self.current_vectorstore = None
         self.current_mode = None
         self.session_vectorstore = None
+        self.index_report = ""
+        self.ready = threading.Event()  # Cleared while a session restore is hydrating the vectorstore
+        self.ready.set()
         print("VectorStore Injector initialized.")
 
     def set_session_vectorstore(self, vectorstore):
@@ -33,22 +90,1062 @@ class ContextInjector:
             print("Session-specific vectorstore cleared.")
 
     def load_session_vectorstore(self, session_id):
-        vs_path = Path("data/vectors") / f"session_{session_id}"  # Updated path
-        if vs_path.exists():
-            embeddings = HuggingFaceEmbeddings(model_name="all-MiniLM-L6-v2")
-            self.session_vectorstore = FAISS.load_local(
+        self.session_vectorstore = self.read_session_vectorstore(session_id)
+
+    def read_session_vectorstore(self, session_id):
+        """Load a session's saved vectorstore from disk without making it current."""
+        vs_path = Path(temporary.VECTORSTORE_DIR) / f"session_{session_id}"  # Updated path
+        if (vs_path / "manifest.json").exists():
+            vectorstore = load_segmented_vectorstore(vs_path)
+        elif vs_path.exists():
+            vectorstore = FAISS.load_local(
                 str(vs_path),
-                embeddings=embeddings,
+                embeddings=get_embeddings(),
                 allow_dangerous_deserialization=True
             )
-            print(f"Loaded session vectorstore for session {session_id} from {vs_path}.")
         else:
-            self.session_vectorstore = None
             print(f"No session vectorstore found for session {session_id} at {vs_path}.")
+            return None
+        print(f"Loaded session vectorstore for session {session_id} from {vs_path}.")
+        return vectorstore
+
+    def wait_until_ready(self, timeout=None):
+        """Block until any background session restore has installed its vectorstore."""
+        if not self.ready.is_set():
+            print("Debug: Waiting for session restore to finish before RAG retrieval")
+        return self.ready.wait(timeout)
 
 context_injector = ContextInjector()
 
+class EmbeddingCache:
+    """
+    Persistent, content-addressed store of chunk embeddings for one embedding model.
+
+    Vectors are appended to a float32 file that is read through a memory map, and an
+    index file holds one key per row, so a chunk seen in any earlier session is a hash
+    lookup instead of a forward pass. Keys hash the model name with the chunk text.
+    """
+    def __init__(self, model_name, cache_dir):
+        self.model_name = model_name
+        self.cache_dir = Path(cache_dir) / re.sub(r'[^\w.-]', '_', model_name)
+        self.vectors_path = self.cache_dir / "vectors.f32"
+        self.index_path = self.cache_dir / "index.txt"
+        self.meta_path = self.cache_dir / "meta.json"
+        self.lock = threading.Lock()
+        self.rows = None
+        self.dim = None
+        self.vectors = None
+
+    def key(self, text):
+        return hashlib.blake2b(f"{self.model_name}\0{text}".encode("utf-8"), digest_size=16).hexdigest()
+
+    def load(self):
+        """Read the index, dropping any rows a crash left half-written."""
+        self.rows = {}
+        if not self.meta_path.exists():
+            return
+        with open(self.meta_path, "r") as f:
+            self.dim = json.load(f)["dim"]
+        keys = self.index_path.read_text().split() if self.index_path.exists() else []
+        row_bytes = self.dim * 4
+        vector_rows = self.vectors_path.stat().st_size // row_bytes if self.vectors_path.exists() else 0
+        if vector_rows != len(keys):
+            valid = min(vector_rows, len(keys))
+            keys = keys[:valid]
+            with open(self.vectors_path, "ab") as f:  # "ab" also creates a missing vectors file
+                f.truncate(valid * row_bytes)
+            self.index_path.write_text("".join(f"{k}\n" for k in keys))
+            print(f"Warning: Repaired embedding cache index, kept {valid} rows")
+        self.rows = {k: i for i, k in enumerate(keys)}
+
+    def get_vectors(self):
+        if self.vectors is None and self.rows:
+            self.vectors = np.memmap(self.vectors_path, dtype=np.float32, mode="r", shape=(len(self.rows), self.dim))
+        return self.vectors
+
+    def lookup(self, texts):
+        """Return cached vectors for texts, with None where a text is not cached."""
+        with self.lock:
+            if self.rows is None:
+                self.load()
+            vectors = self.get_vectors()
+            return [vectors[self.rows[k]].tolist() if k in self.rows else None for k in map(self.key, texts)]
+
+    def store(self, texts, embeddings):
+        """Append new vectors; vectors are flushed before their keys so the index never points past the data."""
+        if not texts:
+            return
+        data = np.asarray(embeddings, dtype=np.float32)
+        with self.lock:
+            if self.rows is None:
+                self.load()
+            if self.dim is None:
+                self.cache_dir.mkdir(parents=True, exist_ok=True)
+                self.dim = int(data.shape[1])
+                with open(self.meta_path, "w") as f:
+                    json.dump({"model": self.model_name, "dim": self.dim}, f)
+            new_keys = []
+            seen = set()
+            new_rows = []
+            for text, row in zip(texts, data):
+                key = self.key(text)
+                if key not in self.rows and key not in seen:
+                    seen.add(key)
+                    new_keys.append(key)
+                    new_rows.append(row)
+            if not new_keys:
+                return
+            with open(self.vectors_path, "ab") as f:
+                f.write(np.stack(new_rows).tobytes())
+                f.flush()
+                os.fsync(f.fileno())
+            with open(self.index_path, "a") as f:
+                f.write("".join(f"{k}\n" for k in new_keys))
+            for key in new_keys:
+                self.rows[key] = len(self.rows)
+            self.vectors = None  # Re-map with the new length on next lookup
+
+class CachedEmbeddings(Embeddings):
+    """Embeddings wrapper that answers document embeddings from an EmbeddingCache first."""
+    def __init__(self, base, cache):
+        self.base = base
+        self.cache = cache
+
+    def embed_documents(self, texts):
+        cached = self.cache.lookup(texts)
+        hits = sum(v is not None for v in cached)
+        misses = list(dict.fromkeys(t for t, v in zip(texts, cached) if v is None))
+        if misses:
+            computed = dict(zip(misses, self.base.embed_documents(misses)))
+            self.cache.store(misses, [computed[t] for t in misses])
+            cached = [v if v is not None else list(computed[t]) for t, v in zip(texts, cached)]
+        print(f"Debug: Embedded {len(texts)} chunks, {hits} from cache")
+        return cached
+
+    def embed_query(self, text):
+        return self.base.embed_query(text)
+
+class SentenceSegmenter:
+    """
+    Incremental sentence splitter for streamed model output.
+
+    feed() appends a delta and returns the sentences it completes. Scanning resumes where
+    the previous call stopped, so each character is examined once however long a sentence
+    runs. A '.', '!' or '?' ends a sentence only when followed by whitespace, and a '.' not
+    after a digit, a known abbreviation or a single capital initial. Text inside ```
+    fences is never split; a fenced block ends at the end of its closing fence line.
+    Sentences keep the whitespace that follows them, so joining them restores the text.
+    """
+    ABBREVIATIONS = {"e.g", "i.e", "etc", "vs", "mr", "mrs", "ms", "dr", "prof", "sr", "jr", "st", "fig", "no", "approx", "inc", "ltd"}
+
+    def __init__(self):
+        self.buffer = ""
+        self.pos = 0
+        self.in_fence = False
+        self.fence_closed = False
+
+    def is_boundary(self, buffer, i):
+        if buffer[i] != '.':
+            return True
+        word_start = i
+        while word_start > 0 and not buffer[word_start - 1].isspace():
+            word_start -= 1
+        word = buffer[word_start:i]
+        if not word or word[-1].isdigit():
+            return False
+        if len(word) == 1 and word.isupper():
+            return False
+        return word.lower().lstrip("([\"'") not in self.ABBREVIATIONS
+
+    def feed(self, text):
+        """Add streamed text and return the list of sentences it completed."""
+        buffer, self.buffer = self.buffer, ""
+        buffer += text  # Sole reference, so CPython extends the string in place
+        sentences = []
+        start, i, n = 0, self.pos, len(buffer)
+        while i < n:
+            char = buffer[i]
+            if char == '`':
+                if i + 3 > n:
+                    break  # Wait to see whether this is a fence
+                if buffer.startswith("```", i):
+                    self.in_fence = not self.in_fence
+                    self.fence_closed = not self.in_fence
+                    i += 3
+                    continue
+            elif self.in_fence:
+                pass
+            elif char == '\n' and self.fence_closed:
+                self.fence_closed = False
+                sentences.append(buffer[start:i + 1])
+                start = i + 1
+            elif char in '.!?':
+                if i + 1 == n:
+                    break  # The next character decides, e.g. "3." followed by "14"
+                if buffer[i + 1].isspace() and self.is_boundary(buffer, i):
+                    i += 2
+                    while i < n and buffer[i].isspace():
+                        i += 1  # Keep the whole whitespace run, so paragraph breaks survive
+                    sentences.append(buffer[start:i])
+                    start = i
+                    continue
+            i += 1
+        self.buffer = buffer[start:] if start else buffer
+        self.pos = i - start
+        return sentences
+
+    def flush(self):
+        """Return whatever text is left unterminated and reset."""
+        remainder = self.buffer.rstrip()
+        self.__init__()
+        return remainder
+
+def find_marker(buffer, marker, added):
+    """Find marker in buffer, looking only where the last `added` characters could complete it."""
+    return buffer.find(marker, max(len(buffer) - added - len(marker), 0))
+
+class PrefixNode:
+    __slots__ = ("children", "key")
+
+    def __init__(self):
+        self.children = {}  # first token -> (edge tokens, child node)
+        self.key = None  # Full token tuple of the snapshot stored at this node
+
+class PrefixTreeCache:
+    """
+    Bounded LRU cache of llama.cpp state snapshots, indexed by a radix tree of token ids.
+
+    Implements the llama_cpp BaseLlamaCache interface, so Llama consults it before each
+    completion and stores a snapshot after it. A lookup walks the tree along the new
+    prompt in O(prompt length) and returns the most recent snapshot sharing the longest
+    prefix with it, so a regenerated answer or an edited message resumes from the branch
+    point and only the divergent tokens are evaluated. Snapshots are evicted least
+    recently used first once their total size passes capacity_bytes.
+    """
+    def __init__(self, capacity_bytes):
+        self.capacity_bytes = capacity_bytes
+        self.root = PrefixNode()
+        self.states = OrderedDict()
+        self.recency = {}
+        self.clock = 0
+
+    @property
+    def cache_size(self):
+        return sum(state.llama_state_size for state in self.states.values())
+
+    def _find_longest_prefix_key(self, key):
+        node, i, matched = self.root, 0, 0
+        while i < len(key) and key[i] in node.children:
+            edge, child = node.children[key[i]]
+            common = 0
+            while common < len(edge) and i + common < len(key) and edge[common] == key[i + common]:
+                common += 1
+            matched = i + common
+            node = child
+            if common < len(edge):
+                break
+            i += common
+        if matched == 0:
+            return None
+        # Every snapshot below the point where the walk stopped shares the same prefix; take the newest
+        best, stack = None, [node]
+        while stack:
+            current = stack.pop()
+            if current.key is not None and (best is None or self.recency[current.key] > self.recency[best]):
+                best = current.key
+            stack.extend(child for _, child in current.children.values())
+        print(f"Debug: Prefix cache hit, {matched} of {len(key)} prompt tokens reusable")
+        return best
+
+    def touch(self, key):
+        self.clock += 1
+        self.recency[key] = self.clock
+        self.states.move_to_end(key)
+
+    def __getitem__(self, key):
+        found = self._find_longest_prefix_key(tuple(key))
+        if found is None:
+            raise KeyError("Key not found")
+        self.touch(found)
+        return self.states[found]
+
+    def __contains__(self, key):
+        return self._find_longest_prefix_key(tuple(key)) is not None
+
+    def __setitem__(self, key, value):
+        key = tuple(key)
+        if key not in self.states:
+            self._insert(key)
+        self.states[key] = value
+        self.touch(key)
+        while self.cache_size > self.capacity_bytes and len(self.states) > 1:
+            evicted, _ = self.states.popitem(last=False)
+            del self.recency[evicted]
+            self._remove(self.root, evicted, 0)
+
+    def _insert(self, key):
+        node, i = self.root, 0
+        while i < len(key):
+            if key[i] not in node.children:
+                child = PrefixNode()
+                node.children[key[i]] = (key[i:], child)
+                node = child
+                break
+            edge, child = node.children[key[i]]
+            common = 0
+            while common < len(edge) and i + common < len(key) and edge[common] == key[i + common]:
+                common += 1
+            if common < len(edge):
+                middle = PrefixNode()
+                middle.children[edge[common]] = (edge[common:], child)
+                node.children[key[i]] = (edge[:common], middle)
+                child = middle
+            node = child
+            i += common
+        node.key = key
+
+    def _remove(self, node, key, i):
+        """Drop the snapshot for key below node; returns True when node is left empty."""
+        if i == len(key):
+            node.key = None
+        else:
+            edge, child = node.children[key[i]]
+            if self._remove(child, key, i + len(edge)):
+                del node.children[key[i]]
+        return node.key is None and not node.children
+
+class ConversationCache:
+    """
+    Remember the exact text the model generated for each displayed reply.
+
+    Replies are shown sentence-joined and filtered, so rebuilding the history from
+    the session log would diverge from the tokens already in the KV cache. Looking
+    up the raw text keeps rebuilt prompts token-identical to what was evaluated.
+    """
+    def __init__(self, limit=256):
+        self.limit = limit
+        self.raw_replies = OrderedDict()
+        self.last_raw_reply = None
+
+    def remember(self, display_content):
+        """Pair the last generated raw reply with how it was stored in the session log."""
+        if self.last_raw_reply:
+            key = clean_content('assistant', display_content)
+            self.raw_replies[key] = self.last_raw_reply
+            self.raw_replies.move_to_end(key)
+            while len(self.raw_replies) > self.limit:
+                self.raw_replies.popitem(last=False)
+        self.last_raw_reply = None
+
+    def lookup(self, content):
+        return self.raw_replies.get(content, content)
+
+conversation_cache = ConversationCache()
+
+class AttachmentCache:
+    """
+    Text of attached files, read once and reused until a file's mtime or size changes.
+
+    Each entry keeps the text, a digest, line-aligned chunks with their embeddings for
+    Top-K selection, per-model token counts and the latest rendered excerpt, so a turn
+    with unchanged attachments does no file I/O and re-renders nothing. Files that are no
+    longer attached are dropped on the next load.
+    """
+    def __init__(self):
+        self.entries = {}
+        self.lock = threading.Lock()
+
+    def get(self, file_path):
+        stat = os.stat(file_path)
+        with self.lock:
+            entry = self.entries.get(file_path)
+            if entry and entry["mtime"] == stat.st_mtime and entry["size"] == stat.st_size:
+                return entry
+        with open(file_path, 'r', encoding='utf-8', errors='replace') as f:
+            text = f.read()
+        entry = {
+            "name": Path(file_path).name,
+            "mtime": stat.st_mtime,
+            "size": stat.st_size,
+            "text": text,
+            "digest": hashlib.blake2b(text.encode("utf-8"), digest_size=16).hexdigest(),
+            "chunks": split_attachment_text(text),
+            "vectors": None,
+            "tokens": {},
+            "renders": {}
+        }
+        with self.lock:
+            self.entries[file_path] = entry
+        print(f"Debug: Cached attachment {entry['name']} ({len(text)} chars, {len(entry['chunks'])} chunks)")
+        return entry
+
+    def load(self, file_paths):
+        """Return entries for the given files, dropping cached files no longer attached."""
+        with self.lock:
+            for stale in set(self.entries) - set(file_paths or []):
+                del self.entries[stale]
+        entries = []
+        for file_path in file_paths or []:
+            try:
+                entries.append(self.get(file_path))
+            except Exception as e:
+                print(f"Error reading attached file {file_path}: {e}")
+        return entries
+
+attachment_cache = AttachmentCache()
+
+class ContextBudget:
+    """
+    Fit each prompt into temporary.CONTEXT_SIZE using the loaded model's tokenizer.
+
+    The context is split between the system prompt, the current input, web results,
+    RAG chunks, history and a generation reserve. Token counts are cached per text, and
+    the point where history was last trimmed is remembered per session so the kept
+    prefix stays the same across turns until it overflows again.
+    """
+    def __init__(self, cache_limit=4096):
+        self.cache_limit = cache_limit
+        self.token_counts = OrderedDict()
+        self.history_starts = {}
+
+    def count_tokens(self, llm, text):
+        key = (temporary.MODEL_NAME, hash(text))
+        count = self.token_counts.get(key)
+        if count is None:
+            count = len(llm.tokenize(text.encode("utf-8"), add_bos=False))
+            self.token_counts[key] = count
+            while len(self.token_counts) > self.cache_limit:
+                self.token_counts.popitem(last=False)
+        else:
+            self.token_counts.move_to_end(key)
+        return count + temporary.BUDGET_MESSAGE_OVERHEAD
+
+    def truncate(self, llm, text, max_tokens):
+        """Cut text to at most max_tokens tokens, marking the cut."""
+        tokens = llm.tokenize(text.encode("utf-8"), add_bos=False)
+        if len(tokens) <= max_tokens:
+            return text
+        marker = "\n...[truncated to fit context]"
+        keep = max(max_tokens - len(llm.tokenize(marker.encode("utf-8"), add_bos=False)), 0)
+        return llm.detokenize(tokens[:keep]).decode("utf-8", errors="ignore") + marker
+
+    def head_tail(self, llm, text, max_tokens):
+        """Cut text to at most max_tokens tokens, keeping its beginning and end."""
+        tokens = llm.tokenize(text.encode("utf-8"), add_bos=False)
+        if len(tokens) <= max_tokens:
+            return text
+        marker = "\n...[middle omitted to fit context]...\n"
+        keep = max(max_tokens - len(llm.tokenize(marker.encode("utf-8"), add_bos=False)), 0)
+        head = llm.detokenize(tokens[:keep // 2]).decode("utf-8", errors="ignore")
+        tail = llm.detokenize(tokens[len(tokens) - (keep - keep // 2):]).decode("utf-8", errors="ignore")
+        return head + marker + tail
+
+    def attachment_tokens(self, llm, entry):
+        if temporary.MODEL_NAME not in entry["tokens"]:
+            entry["tokens"][temporary.MODEL_NAME] = len(llm.tokenize(entry["text"].encode("utf-8"), add_bos=False))
+        return entry["tokens"][temporary.MODEL_NAME]
+
+    def select_chunks(self, llm, entry, query, max_tokens):
+        """Keep the attachment chunks most similar to the query, in file order, within max_tokens."""
+        try:
+            embeddings = get_embeddings()
+            if entry["vectors"] is None:
+                vectors = np.array(embeddings.embed_documents(entry["chunks"]), dtype=np.float32)
+                entry["vectors"] = vectors / np.maximum(np.linalg.norm(vectors, axis=1, keepdims=True), 1e-12)
+            query_vector = np.array(embeddings.embed_query(query), dtype=np.float32)
+            scores = entry["vectors"] @ query_vector
+        except Exception as e:
+            print(f"Debug: Attachment chunk ranking failed, using head/tail: {e}")
+            return self.head_tail(llm, entry["text"], max_tokens)
+        chosen, used = [], 0
+        for i in np.argsort(-scores):
+            cost = self.count_tokens(llm, entry["chunks"][i])
+            if used + cost <= max_tokens:
+                chosen.append(i)
+                used += cost
+        return "\n...\n".join(entry["chunks"][i] for i in sorted(chosen))
+
+    def fit_attachments(self, llm, attachments, query, limit):
+        """
+        Render attached files into at most limit tokens.
+
+        Smaller files are placed first and unused budget carries over to larger ones. Each
+        file is sent whole when it fits, otherwise as Top-K chunks relevant to the query or
+        its head and tail, per temporary.ATTACH_INJECT_MODE.
+
+        Returns:
+            str: The rendered attachments, or "" when there are none.
+        """
+        parts = {}
+        remaining = limit
+        ordered = sorted(range(len(attachments)), key=lambda i: self.attachment_tokens(llm, attachments[i]))
+        for position, index in enumerate(ordered):
+            entry = attachments[index]
+            share = max(remaining // (len(ordered) - position), 0)
+            tokens = self.attachment_tokens(llm, entry)
+            mode = temporary.ATTACH_INJECT_MODE
+            if mode == "Auto":
+                mode = "Full" if tokens <= share else "Top-K" if query.strip() else "Head/Tail"
+            if mode == "Top-K":
+                body = self.select_chunks(llm, entry, query, share)
+            else:
+                key = (temporary.MODEL_NAME, mode, share)
+                if key not in entry["renders"]:
+                    if tokens <= share:
+                        render = entry["text"]
+                    elif mode == "Full":
+                        render = self.truncate(llm, entry["text"], share)
+                    else:
+                        render = self.head_tail(llm, entry["text"], share)
+                    entry["renders"] = {key: render}  # Only the latest render, a new share replaces it
+                body = entry["renders"][key]
+            parts[index] = f"Attached File Content ({entry['name']}):\n{body}"
+            remaining -= tokens if body is entry["text"] else share
+        return "\n\n".join(parts[index] for index in sorted(parts))
+
+    def fit(self, llm, system_message, history, user_content, rag_chunks=None, search_results=None, attachments=None,
+            reserve_search=False):
+        """
+        Assemble messages that fit the context window.
+
+        Args:
+            reserve_search (bool): With no search_results yet, still set aside their whole share
+                so history is trimmed as it will be once the results arrive.
+
+        Returns:
+            tuple: (messages, max_tokens) where max_tokens is the generation allowance.
+        """
+        context_size = temporary.CONTEXT_SIZE
+        reserve = min(temporary.BATCH_SIZE, context_size // 4)
+        available = context_size - reserve - self.count_tokens(llm, system_message)
+
+        user_limit = int(max(available, 0) * temporary.BUDGET_USER_SHARE)
+        if self.count_tokens(llm, user_content) > user_limit:
+            user_content = self.truncate(llm, user_content, user_limit - temporary.BUDGET_MESSAGE_OVERHEAD)
+        available -= self.count_tokens(llm, user_content)
+
+        attachment_text = ""
+        if attachments:
+            attachment_text = self.fit_attachments(llm, attachments, user_content, int(max(available, 0) * temporary.BUDGET_ATTACH_SHARE))
+            available -= self.count_tokens(llm, attachment_text)
+
+        search_used = 0
+        if search_results:
+            search_limit = int(available * temporary.BUDGET_SEARCH_SHARE)
+            if self.count_tokens(llm, search_results) > search_limit:
+                search_results = self.truncate(llm, search_results, search_limit - temporary.BUDGET_MESSAGE_OVERHEAD)
+            search_used = self.count_tokens(llm, search_results)
+        elif reserve_search:
+            search_used = int(available * temporary.BUDGET_SEARCH_SHARE)
+
+        rag_limit = int(available * temporary.BUDGET_RAG_SHARE)
+        rag_used = 0
+        kept_chunks = []
+        for chunk in rag_chunks or []:
+            cost = self.count_tokens(llm, chunk)
+            if rag_used + cost > rag_limit:
+                break
+            kept_chunks.append(chunk)
+            rag_used += cost
+        available -= search_used + rag_used
+
+        session_key = temporary.current_session_id
+        start = self.history_starts.get(session_key, 0)
+        if start > len(history):
+            start = 0
+        costs = [self.count_tokens(llm, msg['content']) for msg in history]
+        if sum(costs[start:]) > available:
+            target = available * temporary.BUDGET_TRIM_TARGET
+            while start < len(history) and (sum(costs[start:]) > target or history[start]['role'] != 'user'):
+                start += 1
+            print(f"Debug: Context budget trimmed history to messages {start}-{len(history)}")
+        self.history_starts[session_key] = start
+        kept_history = history[start:]
+        if start:
+            system_message = f"{system_message}\n\n({start} earlier messages of this conversation are omitted to fit the context window.)"
+
+        if attachment_text:
+            user_content = f"{user_content}\n\n{attachment_text}"
+        if kept_chunks:
+            user_content = f"{user_content}\n\nRelevant context from attached documents:\n" + "\n".join(kept_chunks)
+        if search_results:
+            user_content = f"{user_content}\n\nWeb Search Results:\n{search_results}"
+        messages = [{"role": "system", "content": system_message}] + kept_history + [{"role": "user", "content": user_content}]
+
+        prompt_tokens = sum(self.count_tokens(llm, msg['content']) for msg in messages)
+        max_tokens = max(min(temporary.BATCH_SIZE, context_size - prompt_tokens), 1)
+        print(
+            f"Debug: Context budget {prompt_tokens}/{context_size} tokens "
+            f"(history {len(kept_history)} msgs, {len(kept_chunks)} RAG chunks, max_tokens {max_tokens})"
+        )
+        return messages, max_tokens
+
+context_budget = ContextBudget()
+
+class InferenceWorker:
+    """
+    Long-lived thread that runs generation jobs and streams their output into asyncio.
+
+    submit() queues a job and returns an asyncio.Queue bound to the caller's event loop.
+    The worker batches chunks that arrive between event-loop wakeups and hands each batch
+    over with a single loop.call_soon_threadsafe; a None batch ends the job. One thread
+    serves every turn, and a set cancel_event closes the generator at the next chunk so
+    llm_lock is released straight away.
+    """
+    def __init__(self):
+        self.jobs = queue.Queue()
+        self.thread = None
+        self.lock = threading.Lock()
+
+    def submit(self, generator_fn, cancel_event=None):
+        loop = asyncio.get_running_loop()
+        channel = asyncio.Queue()
+        with self.lock:
+            if self.thread is None or not self.thread.is_alive():
+                self.thread = threading.Thread(target=self.run, name="inference-worker", daemon=True)
+                self.thread.start()
+        self.jobs.put((generator_fn, loop, channel, cancel_event))
+        return channel
+
+    def run(self):
+        while True:
+            generator_fn, loop, channel, cancel_event = self.jobs.get()
+            pending = []
+            pending_lock = threading.Lock()
+
+            def deliver():
+                with pending_lock:
+                    batch = pending[:]
+                    pending.clear()
+                channel.put_nowait(batch)
+
+            def send(chunk):
+                with pending_lock:
+                    pending.append(chunk)
+                    if len(pending) > 1:
+                        return  # A delivery is already scheduled and will take this chunk too
+                try:
+                    loop.call_soon_threadsafe(deliver)
+                except RuntimeError:
+                    pass  # The caller's event loop has closed
+
+            generator = None
+            try:
+                generator = generator_fn()
+                for chunk in generator:
+                    if cancel_event and cancel_event.is_set():
+                        send("<CANCELLED>")
+                        break
+                    send(chunk)
+            except Exception as e:
+                send(f"Error: {str(e)}")
+            finally:
+                if generator is not None:
+                    generator.close()
+                send(None)
+
+inference_worker = InferenceWorker()
+
+class DraftModelDecoding:
+    """
+    Draft tokens greedily from a smaller GGUF for llama.cpp speculative decoding.
+
+    The draft model keeps its own KV cache; `Llama.generate` reuses the longest common
+    prefix with the previous call, so each step only evaluates the newly accepted tokens.
+    """
+    def __init__(self, draft_llm, num_pred_tokens=10):
+        self.draft_llm = draft_llm
+        self.num_pred_tokens = num_pred_tokens
+
+    def __call__(self, input_ids, **kwargs):
+        tokens = input_ids.tolist()
+        limit = min(self.num_pred_tokens, self.draft_llm.n_ctx() - len(tokens) - 1)
+        draft = []
+        if limit > 0:
+            for token in self.draft_llm.generate(tokens, top_k=1, temp=0.0, repeat_penalty=1.0, reset=True):
+                if token == self.draft_llm.token_eos():
+                    break
+                draft.append(token)
+                if len(draft) >= limit:
+                    break
+        return np.array(draft, dtype=np.intc)
+
+class SpeculativeDraft:
+    """
+    Wrap a drafter to count its proposals, so each turn can report an acceptance rate.
+
+    llama-cpp-python calls the drafter once per verification step, and every step yields
+    the accepted draft tokens plus one token sampled by the main model.
+    """
+    def __init__(self, drafter, label):
+        self.drafter = drafter
+        self.label = label
+        self.steps = 0
+        self.proposed = 0
+
+    def __call__(self, input_ids, **kwargs):
+        draft = self.drafter(input_ids, **kwargs)
+        self.steps += 1
+        self.proposed += len(draft)
+        return draft
+
+    def supports(self, llm):
+        """A draft model only helps when its token ids mean the same as the main model's."""
+        draft_llm = getattr(self.drafter, "draft_llm", None)
+        return draft_llm is None or draft_llm.n_vocab() == llm.n_vocab()
+
 # Functions...
+def split_attachment_text(text, chunk_chars=None):
+    """Split text into line-aligned chunks of roughly chunk_chars characters."""
+    chunk_chars = chunk_chars or temporary.ATTACH_CHUNK_CHARS
+    chunks, current, size = [], [], 0
+    for line in text.splitlines(keepends=True):
+        if current and size + len(line) > chunk_chars:
+            chunks.append("".join(current))
+            current, size = [], 0
+        current.append(line)
+        size += len(line)
+    if current:
+        chunks.append("".join(current))
+    return chunks
+
+def get_embeddings():
+    """
+    Return the process-wide embedding model, loading it on first use.
+
+    Device, torch thread count and encode batch size come from temporary.EMBEDDING_*.
+    Document embeddings go through the on-disk EmbeddingCache.
+    """
+    global embedding_model
+    with embedding_lock:
+        if embedding_model is None:
+            start = time.perf_counter()
+            if temporary.EMBEDDING_THREADS > 0:
+                import torch
+                torch.set_num_threads(temporary.EMBEDDING_THREADS)
+            base = HuggingFaceEmbeddings(
+                model_name=temporary.EMBEDDING_MODEL,
+                model_kwargs={"device": temporary.EMBEDDING_DEVICE},
+                encode_kwargs={"batch_size": temporary.EMBEDDING_BATCH_SIZE}
+            )
+            embedding_model = CachedEmbeddings(base, EmbeddingCache(temporary.EMBEDDING_MODEL, temporary.EMBEDDING_CACHE_DIR))
+            print(f"Debug: Loaded embedding model '{temporary.EMBEDDING_MODEL}' on {temporary.EMBEDDING_DEVICE} in {time.perf_counter() - start:.1f}s")
+    return embedding_model
+
+def read_vectorstore_manifest(vs_path):
+    manifest_path = Path(vs_path) / "manifest.json"
+    if not manifest_path.exists():
+        return None
+    with open(manifest_path, "r") as f:
+        return json.load(f)
+
+def write_vectorstore_manifest(vs_path, manifest):
+    """Replace the manifest atomically; it is the commit point for every save."""
+    manifest_path = Path(vs_path) / "manifest.json"
+    tmp_path = manifest_path.with_suffix(".tmp")
+    with open(tmp_path, "w") as f:
+        json.dump(manifest, f, indent=4)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, manifest_path)
+
+def write_vector_segment(path, vectors):
+    with open(path, "wb") as f:
+        np.save(f, np.ascontiguousarray(vectors, dtype=np.float32))
+        f.flush()
+        os.fsync(f.fileno())
+
+def append_vectorstore_delta(vs_path, texts, metadatas, ids, vectors, reset=False):
+    """
+    Persist only the chunks added to a session vectorstore since the last save.
+
+    The store directory holds float32 vector segments (seg_NNNNNN.npy), a docstore.jsonl
+    log with one chunk per row and manifest.json, which is written last. Anything an
+    interrupted save wrote past the manifest is ignored on load and overwritten here.
+
+    Args:
+        vs_path (Path): Session vectorstore directory.
+        texts, metadatas, ids (list): The new chunks, in index order.
+        vectors (list): Their embeddings.
+        reset (bool): Discard the existing store first and write these rows as a new one.
+    """
+    vs_path = Path(vs_path)
+    if reset and vs_path.exists():
+        shutil.rmtree(vs_path)
+    vs_path.mkdir(parents=True, exist_ok=True)
+    manifest = read_vectorstore_manifest(vs_path) or {
+        "dim": None, "rows": 0, "docstore_bytes": 0, "segments": [], "next_segment": 1
+    }
+    data = np.asarray(vectors, dtype=np.float32)
+    manifest["dim"] = int(data.shape[1])
+
+    segment_name = f"seg_{manifest['next_segment']:06d}.npy"
+    write_vector_segment(vs_path / segment_name, data)
+
+    docstore_path = vs_path / "docstore.jsonl"
+    with open(docstore_path, "r+b" if docstore_path.exists() else "wb") as f:
+        f.seek(manifest["docstore_bytes"])
+        f.truncate()
+        for doc_id, text, metadata in zip(ids, texts, metadatas):
+            f.write((json.dumps({"id": doc_id, "text": text, "metadata": metadata}) + "\n").encode("utf-8"))
+        f.flush()
+        os.fsync(f.fileno())
+        manifest["docstore_bytes"] = f.tell()
+
+    manifest["segments"].append({"file": segment_name, "rows": len(ids)})
+    manifest["rows"] += len(ids)
+    manifest["next_segment"] += 1
+    stale_segments = []
+    if len(manifest["segments"]) > temporary.VECTOR_SEGMENT_LIMIT:
+        merged_name = f"seg_{manifest['next_segment']:06d}.npy"
+        merged = np.concatenate([np.load(vs_path / seg["file"], mmap_mode="r") for seg in manifest["segments"]])
+        write_vector_segment(vs_path / merged_name, merged)
+        stale_segments = [seg["file"] for seg in manifest["segments"]]
+        manifest["segments"] = [{"file": merged_name, "rows": manifest["rows"]}]
+        manifest["next_segment"] += 1
+    write_vectorstore_manifest(vs_path, manifest)
+    for name in stale_segments:
+        (vs_path / name).unlink(missing_ok=True)
+    print(f"Debug: Saved {len(ids)} new chunks to {vs_path} ({manifest['rows']} total, {len(manifest['segments'])} segments)")
+
+def resolve_index_type(rows):
+    """Pick the FAISS index type for a store of the given size."""
+    if temporary.VECTOR_INDEX_TYPE != "Auto":
+        return temporary.VECTOR_INDEX_TYPE
+    for index_type, max_rows in temporary.VECTOR_INDEX_THRESHOLDS.items():
+        if rows <= max_rows:
+            return index_type
+    return "IVF-PQ"
+
+def apply_index_search_params(index):
+    """Set query-time accuracy/speed knobs, which are not reliably kept by write_index."""
+    import faiss
+    if hasattr(index, "hnsw"):
+        index.hnsw.efSearch = 64
+    ivf = faiss.try_extract_index_ivf(index)
+    if ivf is not None:
+        ivf.nprobe = min(ivf.nlist, 16)
+    return index
+
+def build_faiss_index(vectors, index_type):
+    """
+    Build and populate a FAISS index of the given type, training it first if needed.
+
+    IVF-PQ falls back to HNSW when there are too few vectors to train its codebooks.
+    """
+    import faiss
+    vectors = np.ascontiguousarray(vectors, dtype=np.float32)
+    rows, dim = vectors.shape
+    if index_type == "IVF-PQ":
+        nlist = max(1, min(int(4 * np.sqrt(rows)), rows // 39))
+        m = next((m for m in (64, 48, 32, 24, 16, 12, 8, 4, 2) if dim % m == 0 and dim // m >= 4), 1)
+        if rows < 256 * 39:
+            index_type = "HNSW"
+        else:
+            index = faiss.IndexIVFPQ(faiss.IndexFlatL2(dim), dim, nlist, m, 8)
+            index.train(vectors)
+    if index_type == "HNSW":
+        index = faiss.IndexHNSWFlat(dim, 32)
+        index.hnsw.efConstruction = 80
+    elif index_type == "Flat":
+        index = faiss.IndexFlatL2(dim)
+    index.add(vectors)
+    return apply_index_search_params(index), index_type
+
+def measure_index_quality(index, vectors, k=3, samples=32):
+    """
+    Estimate recall@k against exact search and mean query latency for an index.
+
+    Returns:
+        tuple: (recall, milliseconds per query)
+    """
+    import faiss
+    rows = vectors.shape[0]
+    picks = np.random.default_rng(0).choice(rows, size=min(samples, rows), replace=False)
+    queries = np.ascontiguousarray(vectors[np.sort(picks)], dtype=np.float32)
+    start = time.perf_counter()
+    _, found = index.search(queries, k)
+    latency_ms = (time.perf_counter() - start) * 1000 / len(queries)
+    if isinstance(index, faiss.IndexFlat):
+        return 1.0, latency_ms
+    _, exact = faiss.knn(queries, np.ascontiguousarray(vectors, dtype=np.float32), k)
+    hits = sum(len(set(f) & set(e)) for f, e in zip(found.tolist(), exact.tolist()))
+    return hits / exact.size, latency_ms
+
+def load_vector_segments(vs_path, manifest):
+    """Concatenate a store's memory-mapped vector segments."""
+    segments = [np.load(Path(vs_path) / seg["file"], mmap_mode="r") for seg in manifest["segments"]]
+    return segments[0] if len(segments) == 1 else np.concatenate(segments)
+
+def update_vectorstore_index(vs_path, vectorstore):
+    """
+    Keep a saved store's index type in line with its size, and snapshot trained indexes.
+
+    Flat indexes are rebuilt from the segments on load, so only HNSW and IVF-PQ keep an
+    index.faiss snapshot; it is refreshed when the rows added since exceed a fifth of it.
+    The segments are only read when the index is rebuilt or snapshotted, so a routine
+    upload costs nothing beyond its own chunks; the report then reuses the last measured
+    recall and latency.
+
+    Returns:
+        str: Index type, size, recall and latency report.
+    """
+    import faiss
+    vs_path = Path(vs_path)
+    manifest = read_vectorstore_manifest(vs_path)
+    rows = manifest["rows"]
+    requested = resolve_index_type(rows)
+    snapshot = manifest.get("snapshot")
+    index_type = snapshot["type"] if snapshot else "Flat"
+    # IVF-PQ is built as HNSW until there are enough rows to train it, so compare what was asked for
+    snapshot_requested = snapshot.get("requested", index_type) if snapshot else "Flat"
+    grown = snapshot is not None and rows - snapshot["rows"] > snapshot["rows"] // 5
+    trainable = requested != "IVF-PQ" or rows >= 256 * 39  # build_faiss_index's IVF-PQ minimum
+    rebuild = (requested != snapshot_requested or vectorstore.index.ntotal != rows
+               or (grown and index_type != requested and trainable))
+    if rebuild or grown or "quality" not in manifest:
+        vectors = load_vector_segments(vs_path, manifest)
+        if rebuild:
+            start = time.perf_counter()
+            index, index_type = build_faiss_index(vectors, requested)
+            vectorstore.index = index
+            print(f"Debug: Built {index_type} index over {rows} chunks in {time.perf_counter() - start:.1f}s")
+        if index_type == "Flat":
+            manifest.pop("snapshot", None)
+            (vs_path / "index.faiss").unlink(missing_ok=True)
+        elif rebuild or grown:
+            tmp_path = vs_path / "index.faiss.tmp"
+            faiss.write_index(vectorstore.index, str(tmp_path))
+            os.replace(tmp_path, vs_path / "index.faiss")
+            manifest["snapshot"] = {"file": "index.faiss", "rows": rows, "type": index_type, "requested": requested}
+        recall, latency_ms = measure_index_quality(vectorstore.index, vectors)
+        manifest["quality"] = {"recall": recall, "latency_ms": latency_ms}
+        write_vectorstore_manifest(vs_path, manifest)
+    quality = manifest["quality"]
+    report = f"{index_type} index, {rows} chunks, recall@3 {quality['recall']:.2f}, {quality['latency_ms']:.3f} ms/query"
+    print(f"Debug: {report}")
+    return report
+
+def export_vectorstore_rows(vectorstore):
+    """Read every chunk and vector back out of a FAISS store, in index order."""
+    count = vectorstore.index.ntotal
+    ids = [vectorstore.index_to_docstore_id[i] for i in range(count)]
+    docs = [vectorstore.docstore.search(doc_id) for doc_id in ids]
+    vectors = vectorstore.index.reconstruct_n(0, count)
+    return [d.page_content for d in docs], [d.metadata for d in docs], ids, vectors
+
+def load_vector_segments_after(vs_path, manifest, start_row):
+    """Yield the memory-mapped rows from start_row on, reading only the segments that hold them."""
+    offset = 0
+    for segment in manifest["segments"]:
+        end = offset + segment["rows"]
+        if end > start_row:
+            vectors = np.load(Path(vs_path) / segment["file"], mmap_mode="r")
+            yield vectors[max(0, start_row - offset):]
+        offset = end
+
+def load_segmented_vectorstore(vs_path):
+    """
+    Rebuild a session FAISS store from its memory-mapped vector segments and docstore log.
+
+    An HNSW snapshot is memory-mapped with IO_FLAG_MMAP, so its vectors are paged in as
+    searches touch them; IVF-PQ snapshots are read into RAM, as faiss maps their lists
+    read-only and later uploads must add to them. Only the rows saved after the snapshot
+    are read from the segments. Without a snapshot (Flat stores) the segment files are
+    memory-mapped, but IndexFlatL2 copies their vectors into RAM.
+    """
+    import faiss
+    from langchain_community.docstore.in_memory import InMemoryDocstore
+    from langchain_core.documents import Document
+    vs_path = Path(vs_path)
+    manifest = read_vectorstore_manifest(vs_path)
+    snapshot = manifest.get("snapshot")
+    if snapshot and (vs_path / snapshot["file"]).exists():
+        io_flags = faiss.IO_FLAG_MMAP if snapshot["type"] == "HNSW" else 0
+        index = apply_index_search_params(faiss.read_index(str(vs_path / snapshot["file"]), io_flags))
+        for vectors in load_vector_segments_after(vs_path, manifest, snapshot["rows"]):
+            if len(vectors):
+                index.add(np.ascontiguousarray(vectors))
+    else:
+        index = faiss.IndexFlatL2(manifest["dim"])
+        for segment in manifest["segments"]:
+            index.add(np.ascontiguousarray(np.load(vs_path / segment["file"], mmap_mode="r")))
+    with open(vs_path / "docstore.jsonl", "rb") as f:
+        records = [json.loads(line) for line in f.read(manifest["docstore_bytes"]).decode("utf-8").splitlines()]
+    docstore = InMemoryDocstore({
+        r["id"]: Document(page_content=r["text"], metadata=r["metadata"]) for r in records
+    })
+    index_to_docstore_id = {i: r["id"] for i, r in enumerate(records)}
+    return FAISS(get_embeddings(), index, docstore, index_to_docstore_id)
+
+def read_gguf_metadata(model_path: str) -> dict:
+    """
+    Read the key/value header of a GGUF file without loading the model.
+
+    Only the header pages are touched through a read-only memory map, parsing stops
+    before the tensor infos, and large arrays (tokenizer vocab, merges) are skipped.
+
+    Args:
+        model_path (str): Path to the GGUF model file.
+
+    Returns:
+        dict: Metadata keys mapped to their decoded values.
+    """
+    with open(model_path, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        if mm[:4] != b"GGUF":
+            raise ValueError(f"'{model_path}' is not a GGUF file")
+        endian = "<"
+        version = struct.unpack_from("<I", mm, 4)[0]
+        if version & 0xFFFF == 0:  # Big-endian files store a byte-swapped version
+            endian = ">"
+            version = struct.unpack_from(">I", mm, 4)[0]
+        count_fmt = endian + ("I" if version == 1 else "Q")
+        count_size = struct.calcsize(count_fmt)
+        offset = 8 + count_size  # Skip magic, version and tensor count
+        kv_count = struct.unpack_from(count_fmt, mm, offset)[0]
+        offset += count_size
+
+        def read_string(offset):
+            length = struct.unpack_from(count_fmt, mm, offset)[0]
+            offset += count_size
+            return mm[offset:offset + length].decode("utf-8", errors="replace"), offset + length
+
+        def read_value(value_type, offset):
+            if value_type == GGUF_TYPE_STRING:
+                return read_string(offset)
+            if value_type == GGUF_TYPE_ARRAY:
+                item_type = struct.unpack_from(endian + "I", mm, offset)[0]
+                item_count = struct.unpack_from(count_fmt, mm, offset + 4)[0]
+                offset += 4 + count_size
+                keep = item_count <= GGUF_ARRAY_LIMIT
+                if item_type in GGUF_SCALAR_FORMATS and not keep:
+                    return None, offset + item_count * struct.calcsize(GGUF_SCALAR_FORMATS[item_type])
+                items = []
+                for _ in range(item_count):
+                    if item_type == GGUF_TYPE_STRING and not keep:
+                        length = struct.unpack_from(count_fmt, mm, offset)[0]
+                        offset += count_size + length
+                        continue
+                    item, offset = read_value(item_type, offset)
+                    items.append(item)
+                return (items if keep else None), offset
+            if value_type not in GGUF_SCALAR_FORMATS:
+                raise ValueError(f"Unknown GGUF value type {value_type}")
+            fmt = endian + GGUF_SCALAR_FORMATS[value_type]
+            value = struct.unpack_from(fmt, mm, offset)[0]
+            if value_type == GGUF_TYPE_BOOL:
+                value = bool(value)
+            return value, offset + struct.calcsize(fmt)
+
+        metadata = {}
+        for _ in range(kv_count):
+            key, offset = read_string(offset)
+            value_type = struct.unpack_from(endian + "I", mm, offset)[0]
+            value, offset = read_value(value_type, offset + 4)
+            if value is not None:
+                metadata[key] = value
+        return metadata
+
 def get_model_metadata(model_path: str) -> dict:
     """
     Retrieve metadata from a GGUF model, including the number of layers.
@@ -60,94 +1157,110 @@ def get_model_metadata(model_path: str) -> dict:
         dict: Metadata with 'layers' key, or empty dict on failure.
     """
     try:
-        from llama_cpp import Llama
-        # First attempt: Use model.metadata (more reliable than verbose output)
-        model = Llama(
-            model_path=model_path,
-            n_ctx=512,  # Minimal context for metadata
-            n_batch=1,
-            n_gpu_layers=0,
-            verbose=False  # Avoid verbose output unless needed
-        )
-        metadata = model.metadata  # Direct access to GGUF metadata
-        del model
-        print(f"Debug: Metadata keys for '{model_path}': {list(metadata.keys())}")
-
-        # Extract architecture and layers
-        architecture = metadata.get('general.architecture', 'unknown')
-        print(f"Debug: Detected architecture: {architecture}")
-        layers = metadata.get(f'{architecture}.block_count', 0)
-
-        # Fallback: Search for alternative layer count keys
-        if layers == 0:
-            for key in metadata:
-                if 'block_count' in key or 'layer_count' in key:
-                    layers = metadata[key]
-                    print(f"Debug: Found layers ({layers}) in key '{key}'")
-                    break
-            else:
-                layers = 0
+        metadata = read_gguf_metadata(model_path)
+    except Exception as e:
+        print(f"Error reading model metadata for '{model_path}': {e}")
+        return {}
+    print(f"Debug: Metadata keys for '{model_path}': {list(metadata.keys())}")
 
-        metadata['layers'] = layers
-        if layers == 0:
-            print(f"Warning: Could not determine layer count for '{model_path}'. Metadata: {metadata}")
-        else:
-            print(f"Debug: Found {layers} layers for '{model_path}'")
-        return metadata
+    # Extract architecture and layers
+    architecture = metadata.get('general.architecture', 'unknown')
+    print(f"Debug: Detected architecture: {architecture}")
+    layers = metadata.get(f'{architecture}.block_count', 0)
+
+    # Fallback: Search for alternative layer count keys
+    if layers == 0:
+        layers = next((value for key, value in metadata.items() if 'block_count' in key or 'layer_count' in key), 0)
+        if layers:
+            print(f"Debug: Found layers ({layers}) in fallback key")
 
-    except AttributeError:
-        # Fallback to verbose output if metadata attribute is unavailable
-        print("Debug: model.metadata not available, falling back to verbose output")
+    metadata['layers'] = layers
+    if layers == 0:
+        print(f"Warning: Could not determine layer count for '{model_path}'. Metadata keys: {list(metadata.keys())}")
+    else:
+        print(f"Debug: Found {layers} layers for '{model_path}'")
+    return metadata
+
+def load_model_info_cache() -> dict:
+    """Load the on-disk model info cache once per process."""
+    global model_info_cache
+    if model_info_cache is None:
+        cache_path = Path(temporary.MODEL_INFO_CACHE)
         try:
-            import re
-            import io
-            from contextlib import redirect_stdout, redirect_stderr
-            output_buffer = io.StringIO()
-            with redirect_stdout(output_buffer), redirect_stderr(output_buffer):
-                model = Llama(
-                    model_path=model_path,
-                    n_ctx=512,
-                    n_batch=1,
-                    n_gpu_layers=0,
-                    verbose=True
-                )
-                del model
-            output = output_buffer.getvalue()
-            print(f"Debug: Raw output for '{model_path}':\n{output}")
-            metadata = {}
-            for line in output.splitlines():
-                if line.startswith("llama_model_loader: - kv"):
-                    match = re.search(r'llama_model_loader: - kv\s+\d+:\s+([\w\.]+)\s+(\w+(?:\[.*?\])?)\s+=\s+(.*)', line)
-                    if match:
-                        key = match.group(1)
-                        type_str = match.group(2).split('[')[0]
-                        value_str = match.group(3).strip()
-                        if type_str == 'u32':
-                            value = int(value_str)
-                        elif type_str == 'f32':
-                            value = float(value_str)
-                        elif type_str == 'str':
-                            value = value_str
-                        elif type_str == 'bool':
-                            value = value_str.lower() == 'true'
-                        else:
-                            value = value_str
-                        metadata[key] = value
-
-            architecture = metadata.get('general.architecture', 'unknown')
-            layers = metadata.get(f'{architecture}.block_count', 0)
-            if layers == 0:
-                layers = next((value for key, value in metadata.items() if 'block_count' in key or 'layer_count' in key), 0)
-            metadata['layers'] = layers
-            if layers == 0:
-                print(f"Warning: Could not determine layer count. Metadata keys: {list(metadata.keys())}")
-            return metadata
+            with open(cache_path, "r") as f:
+                model_info_cache = json.load(f)
+        except (FileNotFoundError, json.JSONDecodeError):
+            model_info_cache = {}
         except Exception as e:
-            print(f"Error reading metadata (verbose fallback): {e}")
-            return {}
+            print(f"Error loading model info cache: {e}")
+            model_info_cache = {}
+    return model_info_cache
+
+def save_model_info_cache():
+    """Write the model info cache atomically so a crash never leaves a torn file."""
+    cache_path = Path(temporary.MODEL_INFO_CACHE)
+    try:
+        cache_path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = cache_path.with_suffix(".tmp")
+        with open(tmp_path, "w") as f:
+            json.dump(model_info_cache, f, indent=4)
+        os.replace(tmp_path, cache_path)
     except Exception as e:
-        print(f"Error reading model metadata for '{model_path}': {e}")
+        print(f"Error saving model info cache: {e}")
+
+def get_model_info(model_path: str) -> dict:
+    """
+    Get cached header details for a GGUF model, re-reading only when the file changed.
+
+    Entries are keyed on the absolute path and validated against st_size and st_mtime.
+
+    Args:
+        model_path (str): Path to the GGUF model file.
+
+    Returns:
+        dict: Size, architecture, block_count, embedding_length, context_length,
+        quantization, size_label and organization, or empty dict on failure.
+    """
+    path = Path(model_path).resolve()
+    try:
+        stat = path.stat()
+    except OSError as e:
+        print(f"Error reading model file '{path}': {e}")
         return {}
+    key = str(path)
+    with model_info_lock:
+        entry = load_model_info_cache().get(key)
+        if entry and entry.get("size") == stat.st_size and entry.get("mtime") == stat.st_mtime:
+            return entry
+
+    metadata = get_model_metadata(key)
+    if not metadata:
+        return {}
+    architecture = metadata.get('general.architecture', 'unknown')
+    file_type = metadata.get('general.file_type')
+    entry = {
+        "size": stat.st_size,
+        "mtime": stat.st_mtime,
+        "architecture": architecture,
+        "block_count": int(metadata.get('layers', 0) or 0),
+        "embedding_length": metadata.get(f'{architecture}.embedding_length', 'Unknown'),
+        "context_length": metadata.get(f'{architecture}.context_length', 'Unknown'),
+        "quantization": GGUF_FILE_TYPES.get(file_type, f"Type {file_type}" if file_type is not None else "Unknown"),
+        "size_label": metadata.get('general.size_label', 'Unknown'),
+        "organization": metadata.get('general.organization', 'Unknown')
+    }
+    with model_info_lock:
+        load_model_info_cache()[key] = entry
+        save_model_info_cache()
+    return entry
+
+def warm_model_info_cache(models):
+    """Fill the model info cache for a folder in the background."""
+    def worker():
+        for model in models:
+            if model != "Browse_for_model_folder...":
+                get_model_info(str(Path(temporary.MODEL_FOLDER) / model))
+    threading.Thread(target=worker, daemon=True).start()
 
 def get_model_layers(model_path: str) -> int:
     """
@@ -159,19 +1272,227 @@ def get_model_layers(model_path: str) -> int:
     Returns:
         int: Number of layers, or 0 if not determined.
     """
-    metadata = get_model_metadata(model_path)
-    layers = metadata.get('layers', 0)
-    return int(layers)  # Ensure conversion to integer
+    return int(get_model_info(model_path).get('block_count', 0))
 
 def get_model_size(model_path: str) -> float:
+    info = get_model_info(model_path)
+    if info:
+        return info["size"] / (1024 * 1024)
     return Path(model_path).stat().st_size / (1024 * 1024)
 
 def clean_content(role, content):
     """Remove prefixes from session_log content for model input."""
     if role == 'user':
         return content.replace("User:\n", "", 1).strip()
+    if role == 'assistant' and content.startswith("AI-Chat:\n"):
+        return content[len("AI-Chat:\n"):].strip()
     return content.strip()
 
+def build_conversation_messages(session_log, system_message, llm, rag_chunks=None, search_results=None, attachments=None,
+                                reserve_search=False):
+    """
+    Build the chat messages for a turn from the whole session log.
+
+    Earlier turns are rendered exactly as on previous turns so llama.cpp can reuse the
+    evaluated prefix; per-turn material (RAG context, web results) is appended to the
+    newest user message only, keeping everything before it stable. The result is fitted
+    to the context window by context_budget.
+
+    Args:
+        session_log (list): Session messages, ending with the pending user/assistant pair.
+        system_message (str): The system prompt.
+        llm: The loaded Llama instance, used for token counts.
+        rag_chunks (list, optional): Retrieved document chunks for this turn, best first.
+        search_results (str, optional): Web search results for this turn.
+        attachments (list, optional): Attached file entries from attachment_cache.load.
+        reserve_search (bool): Budget for web results that are still pending, see ContextBudget.fit.
+
+    Returns:
+        tuple: (messages, max_tokens), or (None, 0) if there is no user input.
+    """
+    if not session_log or len(session_log) < 2 or session_log[-2]['role'] != 'user':
+        return None, 0
+    history = []
+    for msg in session_log[:-2]:
+        if msg['role'] not in ('user', 'assistant'):
+            continue
+        content = clean_content(msg['role'], msg['content'])
+        if msg['role'] == 'assistant':
+            content = conversation_cache.lookup(content)
+        history.append({"role": msg['role'], "content": content})
+    user_content = clean_content('user', session_log[-2]['content'])
+    return context_budget.fit(llm, system_message, history, user_content, rag_chunks, search_results, attachments,
+                              reserve_search=reserve_search)
+
+def session_kv_path(session_id):
+    return Path(temporary.HISTORY_DIR) / f"kv_{session_id}.state"
+
+def kv_state_tag(state):
+    """Identify a saved state by model, context size and a hash of its evaluated tokens."""
+    return {
+        "model": temporary.MODEL_NAME,
+        "ctx": temporary.CONTEXT_SIZE,
+        "prompt_hash": hashlib.blake2b(np.asarray(state.input_ids, dtype=np.int64).tobytes(), digest_size=16).hexdigest()
+    }
+
+def save_session_kv_state(llm, session_id):
+    """
+    Snapshot the model's tokens and KV cache for a session.
+
+    Call with llm_lock held; the snapshot is taken in memory and queued for the writer
+    thread, replacing any older snapshot of the session that has not been written yet.
+    """
+    global kv_state_session, kv_writer_thread
+    if not temporary.KV_PERSIST or not session_id:
+        return
+    kv_state_session = session_id
+    state = llm.save_state()
+    with kv_write_lock:
+        kv_write_pending[session_id] = {"tag": kv_state_tag(state), "state": state}
+        if kv_writer_thread is None:
+            kv_writer_thread = threading.Thread(target=write_session_kv_states, daemon=True)
+            kv_writer_thread.start()
+    kv_write_ready.set()
+
+def write_session_kv_states():
+    """Writer thread: save queued snapshots one at a time, then prune the state files to budget."""
+    while True:
+        kv_write_ready.wait()
+        with kv_write_lock:
+            if not kv_write_pending:
+                kv_write_ready.clear()
+                continue
+            session_id = next(iter(kv_write_pending))
+            saved = kv_write_pending.pop(session_id)
+        path = session_kv_path(session_id)
+        tmp_path = path.with_suffix(".tmp")
+        try:
+            with kv_state_lock:
+                path.parent.mkdir(parents=True, exist_ok=True)
+                with open(tmp_path, "wb") as f:
+                    pickle.dump(saved, f, protocol=pickle.HIGHEST_PROTOCOL)
+                os.replace(tmp_path, path)
+            print(f"Debug: Saved KV state for session {session_id} ({saved['state'].n_tokens} tokens)")
+            prune_session_kv_states(keep=path)
+        except Exception as e:
+            print(f"Warning: Could not save KV state for session {session_id}: {e}")
+
+def prune_session_kv_states(keep=None):
+    """Delete the least recently saved session states beyond KV_PERSIST_BUDGET_MB, never `keep`."""
+    budget = temporary.KV_PERSIST_BUDGET_MB * 1024 * 1024
+    with kv_state_lock:
+        files = sorted(Path(temporary.HISTORY_DIR).glob("kv_*.state"), key=lambda f: f.stat().st_mtime, reverse=True)
+        total = 0
+        for file in files:
+            total += file.stat().st_size
+            if total > budget and file != keep:
+                file.unlink(missing_ok=True)
+                print(f"Debug: Removed KV state {file.name} to stay within {temporary.KV_PERSIST_BUDGET_MB} MB")
+
+def restore_session_kv_state(llm, session_id):
+    """
+    Load a session's saved KV state into the model, if it was saved by the same model and context size.
+
+    Call with llm_lock held, before the first generation after switching sessions; the
+    following completion then only evaluates tokens past the restored prefix.
+    """
+    global kv_state_session
+    if not temporary.KV_PERSIST or not session_id or kv_state_session == session_id:
+        return
+    kv_state_session = session_id
+    with kv_write_lock:
+        saved = kv_write_pending.get(session_id)  # Newer than the file, if not written yet
+    path = session_kv_path(session_id)
+    if saved is None and not path.exists():
+        return
+    try:
+        if saved is None:
+            with kv_state_lock:
+                with open(path, "rb") as f:
+                    saved = pickle.load(f)
+        tag = saved["tag"]
+        if tag["model"] != temporary.MODEL_NAME or tag["ctx"] != temporary.CONTEXT_SIZE:
+            print(f"Debug: KV state for session {session_id} was saved with {tag['model']} at ctx {tag['ctx']}, not restoring")
+            return
+        if kv_state_tag(saved["state"]) != tag:
+            print(f"Warning: KV state for session {session_id} failed its hash check, not restoring")
+            return
+        llm.load_state(saved["state"])
+        print(f"Debug: Restored KV state for session {session_id} ({saved['state'].n_tokens} tokens)")
+    except Exception as e:
+        print(f"Warning: Could not restore KV state for session {session_id}: {e}")
+
+def attach_prompt_cache(llm):
+    """Give the model a prefix-tree state cache so diverging prompts still restore the longest saved prefix."""
+    try:
+        llm.set_cache(PrefixTreeCache(capacity_bytes=temporary.KV_CACHE_SIZE_MB * 1024 * 1024))
+        print(f"Debug: Attached {temporary.KV_CACHE_SIZE_MB} MB prefix-tree state cache")
+    except Exception as e:
+        print(f"Warning: Prompt state cache unavailable: {e}")
+
+def build_speculative_draft(model_folder, model):
+    """
+    Create the drafter for the configured speculative decoding mode.
+
+    Args:
+        model_folder (str): Folder holding the main model and any draft model.
+        model (str): File name of the main model.
+
+    Returns:
+        SpeculativeDraft or None: The counting drafter, or None when off or unavailable.
+    """
+    mode = temporary.SPECULATIVE_MODE
+    try:
+        if mode == "Prompt Lookup":
+            from llama_cpp.llama_speculative import LlamaPromptLookupDecoding
+            drafter = LlamaPromptLookupDecoding(num_pred_tokens=temporary.SPECULATIVE_TOKENS)
+            return SpeculativeDraft(drafter, "prompt lookup")
+        if mode == "Draft Model":
+            draft_path = Path(model_folder) / temporary.DRAFT_MODEL_NAME
+            if temporary.DRAFT_MODEL_NAME in ("None", model) or not draft_path.exists():
+                print(f"Warning: Draft model '{temporary.DRAFT_MODEL_NAME}' unavailable, speculative decoding off")
+                return None
+            from llama_cpp import Llama
+            print(f"Debug: Loading draft model '{temporary.DRAFT_MODEL_NAME}' on CPU")
+            draft_llm = Llama(
+                model_path=str(draft_path),
+                n_ctx=temporary.CONTEXT_SIZE,
+                n_gpu_layers=0,
+                n_batch=temporary.BATCH_SIZE,
+                mmap=temporary.MMAP,
+                verbose=False
+            )
+            drafter = DraftModelDecoding(draft_llm, num_pred_tokens=temporary.SPECULATIVE_TOKENS)
+            return SpeculativeDraft(drafter, f"draft model {temporary.DRAFT_MODEL_NAME}")
+    except Exception as e:
+        print(f"Warning: Speculative decoding unavailable: {e}")
+    return None
+
+def record_generation_stats(tokens, decode_seconds, draft=None, draft_before=(0, 0)):
+    """
+    Store decode throughput for the last turn, with draft acceptance when speculating.
+
+    Args:
+        tokens (int): Tokens sampled by the main model.
+        decode_seconds (float): Time from the first sampled token to the end of the stream.
+        draft (SpeculativeDraft, optional): The model's drafter, if any.
+        draft_before (tuple): Drafter (steps, proposed) counters when the turn started.
+    """
+    generation_stats.clear()
+    rate = (tokens - 1) / decode_seconds if tokens > 1 and decode_seconds > 0 else 0.0
+    generation_stats.update(tokens=tokens, tokens_per_second=rate)
+    summary = f"{rate:.1f} tok/s"
+    if draft is not None:
+        steps = draft.steps - draft_before[0]
+        proposed = draft.proposed - draft_before[1]
+        # Each verification step yields its accepted draft tokens plus one sampled token
+        accepted = min(max(tokens - 1 - steps, 0), proposed)
+        acceptance = accepted / proposed if proposed else 0.0
+        generation_stats.update(draft_proposed=proposed, draft_accepted=accepted, acceptance_rate=acceptance)
+        summary += f", {acceptance:.0%} of {proposed} drafted tokens accepted"
+    generation_stats["summary"] = summary
+    print(f"Debug: Generated {tokens} tokens, {summary}")
+
 def set_cpu_affinity():
     from scripts import utility
     cpu_only_backends = ["CPU Only - AVX2", "CPU Only - AVX512", "CPU Only - NoAVX", "CPU Only - OpenBLAS"]
@@ -193,6 +1514,7 @@ def get_available_models():
     models = [f.name for f in files if f.is_file()]
     if models:
         choices = models
+        warm_model_info_cache(models)
     else:
         choices = ["Browse_for_model_folder..."]
     print(f"Models Found: {choices}")
@@ -219,24 +1541,28 @@ def calculate_gpu_layers(models, available_vram):
     from math import floor
     if not models or available_vram <= 0:
         return {model: 0 for model in models}
-    total_size = sum(get_model_size(Path(MODEL_FOLDER) / model) for model in models if model != "Browse_for_model_folder...")
+    infos = {
+        model: get_model_info(str(Path(temporary.MODEL_FOLDER) / model))
+        for model in models if model != "Browse_for_model_folder..."
+    }
+    sizes = {model: info.get("size", 0) / (1024 * 1024) for model, info in infos.items()}
+    total_size = sum(sizes.values())
     if total_size == 0:
         return {model: 0 for model in models}
     vram_allocations = {
-        model: (get_model_size(Path(MODEL_FOLDER) / model) / total_size) * available_vram
-        for model in models if model != "Browse_for_model_folder..."
+        model: (size / total_size) * available_vram
+        for model, size in sizes.items()
     }
     gpu_layers = {}
     for model in models:
         if model == "Browse_for_model_folder...":
             gpu_layers[model] = 0
             continue
-        model_path = Path(MODEL_FOLDER) / model
-        num_layers = get_model_layers(str(model_path))
+        num_layers = infos[model].get("block_count", 0)
         if num_layers == 0:
             gpu_layers[model] = 0
             continue
-        model_file_size = get_model_size(str(model_path))
+        model_file_size = sizes[model]
         adjusted_model_size = model_file_size * 1.1
         layer_size = adjusted_model_size / num_layers if num_layers > 0 else 0
         max_layers = floor(vram_allocations[model] / layer_size) if layer_size > 0 else 0
@@ -252,25 +1578,27 @@ def inspect_model(model_dir, model_name, vram_size):
         return f"Model file '{model_path}' not found."
     save_config()
     try:
-        metadata = get_model_metadata(str(model_path))
-        architecture = metadata.get('general.architecture', 'unknown')
-        params_str = metadata.get('general.size_label', 'Unknown')
-        layers = metadata.get(f'{architecture}.block_count', 'Unknown')
-        max_ctx = metadata.get(f'{architecture}.context_length', 'Unknown')
-        embed = metadata.get(f'{architecture}.embedding_length', 'Unknown')
-        model_size_mb = get_model_size(str(model_path))
-        model_size_gb = model_size_mb / 1024
+        info = get_model_info(str(model_path))
+        if not info:
+            return f"Error inspecting model: could not read header of '{model_name}'."
+        params_str = info.get('size_label', 'Unknown')
+        layers = info.get('block_count') or 'Unknown'
+        max_ctx = info.get('context_length', 'Unknown')
+        embed = info.get('embedding_length', 'Unknown')
+        quant = info.get('quantization', 'Unknown')
+        model_size_gb = info['size'] / (1024 ** 3)
         if isinstance(layers, int) and layers > 0:
             fit_layers = calculate_single_model_gpu_layers_with_layers(
                 str(model_path), vram_size, layers, DYNAMIC_GPU_LAYERS
             )
         else:
             fit_layers = "Unknown"
-        author = metadata.get('general.organization', 'Unknown')
+        author = info.get('organization', 'Unknown')
         return (
             f"Results: Params = {params_str}, "
             f"Fit/Layers = {fit_layers}/{layers}, "
             f"Size = {model_size_gb:.2f} GB, "
+            f"Quant = {quant}, "
             f"Max Ctx = {max_ctx}, "
             f"Embed = {embed}, "
             f"Author = {author}"
@@ -279,6 +1607,7 @@ def inspect_model(model_dir, model_name, vram_size):
         return f"Error inspecting model: {str(e)}"
 
 def load_models(model_folder, model, vram_size, llm_state, models_loaded_state):
+    global kv_state_session
     from scripts.temporary import CONTEXT_SIZE, BATCH_SIZE, MMAP, DYNAMIC_GPU_LAYERS
     from scripts.utility import save_config
     from pathlib import Path
@@ -311,6 +1640,8 @@ def load_models(model_folder, model, vram_size, llm_state, models_loaded_state):
             unload_models(llm_state, models_loaded_state)
 
         print(f"Debug: Loading model '{model}' from '{model_folder}' with Python bindings")
+        load_start = time.perf_counter()
+        draft = build_speculative_draft(model_folder, model)
         new_llm = Llama(
             model_path=str(model_path),
             n_ctx=temporary.CONTEXT_SIZE,
@@ -318,18 +1649,28 @@ def load_models(model_folder, model, vram_size, llm_state, models_loaded_state):
             n_batch=temporary.BATCH_SIZE,
             mmap=temporary.MMAP,
             mlock=temporary.MLOCK,
+            draft_model=draft,
             verbose=True
         )
+        if draft is not None and not draft.supports(new_llm):
+            print(f"Warning: {draft.label} has a different vocabulary, speculative decoding off")
+            new_llm.draft_model = draft = None
+        load_ms = (time.perf_counter() - load_start) * 1000
+        attach_prompt_cache(new_llm)
+        kv_state_session = None
 
-        test_output = new_llm.create_chat_completion(
-            messages=[{"role": "user", "content": "Hello"}],
-            max_tokens=temporary.BATCH_SIZE,
-            stream=False
-        )
-        print(f"Debug: Test inference successful: {test_output}")
+        probe_ms = probe_model_ready(new_llm, temporary.READY_CHECK)
+        print(f"Debug: Model load took {load_ms:.0f} ms, {temporary.READY_CHECK} probe took {probe_ms:.0f} ms")
 
         temporary.MODEL_NAME = model  # Keep for settings
-        status = f"Model '{model}' loaded successfully. GPU layers: {temporary.GPU_LAYERS}/{num_layers}"
+        if temporary.WARMUP_SYSTEM_PROMPT:
+            warm_up_model(new_llm, get_model_settings(model))
+        status = (
+            f"Model '{model}' loaded successfully. GPU layers: {temporary.GPU_LAYERS}/{num_layers}, "
+            f"ready in {(load_ms + probe_ms) / 1000:.1f}s"
+        )
+        if draft is not None:
+            status += f", speculative decoding with {draft.label}"
         return status, True, new_llm, True
 
     except Exception as e:
@@ -337,6 +1678,57 @@ def load_models(model_folder, model, vram_size, llm_state, models_loaded_state):
         print(error_msg)
         return error_msg, False, None, False
 
+def probe_model_ready(llm, mode="decode") -> float:
+    """
+    Confirm a freshly loaded model works without running a full generation.
+
+    Args:
+        llm: The loaded Llama instance.
+        mode (str): "tokenize" round-trips a short string through the tokenizer,
+            "decode" additionally evaluates it and samples a single token.
+
+    Returns:
+        float: Probe duration in milliseconds.
+    """
+    start = time.perf_counter()
+    tokens = llm.tokenize(b"Hello", add_bos=False)
+    if not tokens or not llm.detokenize(tokens):
+        raise RuntimeError("Tokenizer round-trip returned no data")
+    if mode == "decode":
+        with llm_lock:
+            llm.create_completion(prompt=tokens, max_tokens=1, temperature=0.0)
+    return (time.perf_counter() - start) * 1000
+
+def warm_up_model(llm, settings):
+    """
+    Evaluate the default system prompt into the KV cache on a background thread.
+
+    The next chat completion shares this prefix, so only the user turn is prefilled.
+    """
+    system_message = get_system_message(
+        is_uncensored=settings.get("is_uncensored", False),
+        is_nsfw=settings.get("is_nsfw", False),
+        is_reasoning=settings.get("is_reasoning", False),
+        disable_think=True,
+        is_roleplay=settings.get("is_roleplay", False)
+    )
+
+    def worker():
+        start = time.perf_counter()
+        try:
+            with llm_lock:
+                llm.create_chat_completion(
+                    messages=[{"role": "system", "content": system_message}, {"role": "user", "content": ""}],
+                    max_tokens=1,
+                    temperature=0.0,
+                    stream=False
+                )
+            print(f"Debug: System prompt warm-up took {(time.perf_counter() - start) * 1000:.0f} ms")
+        except Exception as e:
+            print(f"Warning: System prompt warm-up failed: {e}")
+
+    threading.Thread(target=worker, daemon=True).start()
+
 def calculate_single_model_gpu_layers_with_layers(model_path: str, available_vram: int, num_layers: int, dynamic_gpu_layers: bool = True) -> int:
     from math import floor
     if num_layers <= 0 or available_vram <= 0:
@@ -367,31 +1759,31 @@ def generate_summary(text):
         "Summarize the following response in under 256 characters, focusing on critical information and conclusions:\n\n"
         f"{text}"
     )
-    response = temporary.llm.create_chat_completion(
-        messages=[{"role": "user", "content": summary_prompt}],
-        max_tokens=temporary.BATCH_SIZE,  # Fixed from 512
-        temperature=temporary.TEMPERATURE,  # Fixed from 0.5
-        stream=False  # Reasonable for summary
-    )
+    with llm_lock:
+        response = temporary.llm.create_chat_completion(
+            messages=[{"role": "user", "content": summary_prompt}],
+            max_tokens=temporary.BATCH_SIZE,  # Fixed from 512
+            temperature=temporary.TEMPERATURE,  # Fixed from 0.5
+            stream=False  # Reasonable for summary
+        )
     summary = response['choices'][0]['message']['content'].strip()
     if len(summary) > 256:
         summary = summary[:253] + "..."  # Truncate with ellipsis
     return summary
 
 
-# aSync Functions...
-def get_response_stream(session_log, settings, disable_think=False, tot_enabled=False, 
-                       web_search_enabled=False, search_results=None, cancel_event=None, 
-                       llm_state=None, models_loaded_state=False):
-    if not models_loaded_state or llm_state is None:
-        yield "Error: No model loaded. Please load a model first."
-        return
+def prepare_response_messages(session_log, settings, llm_state, disable_think=False, tot_enabled=False,
+                              web_search_enabled=False, search_results=None, rag_chunks=None, attachments=None,
+                              reserve_search=False):
+    """
+    Assemble the system prompt, history, attachments and RAG context for the pending turn.
 
-    print("Debug: Entering get_response_stream")
-    print(f"Debug: session_log = {session_log}")
+    Search results, RAG chunks and attachment entries come from the turn's context stages;
+    a stage that failed or timed out passes None and is left out of the prompt.
 
-    # Build messages (unchanged)
-    messages = []
+    Returns:
+        tuple: (messages, max_tokens) from build_conversation_messages.
+    """
     system_message = get_system_message(
         is_uncensored=settings.get("is_uncensored", False),
         is_nsfw=settings.get("is_nsfw", False),
@@ -401,19 +1793,138 @@ def get_response_stream(session_log, settings, disable_think=False, tot_enabled=
         disable_think=disable_think,
         is_roleplay=settings.get("is_roleplay", False)
     )
-    if web_search_enabled and search_results:
-        system_message += f"\n\nWeb Search Results:\n{search_results}"
-    messages.append({"role": "system", "content": system_message})
-
-    if session_log and len(session_log) >= 2 and session_log[-2]['role'] == 'user':
-        user_content = clean_content('user', session_log[-2]['content'])
-        if context_injector.session_vectorstore:
-            query = user_content
-            docs = context_injector.session_vectorstore.similarity_search(query, k=3)
-            context = "\n".join([doc.page_content for doc in docs])
-            user_content = f"{user_content}\n\nRelevant context from attached documents:\n{context}"
-        messages.append({"role": "user", "content": user_content})
-    else:
+    messages, max_tokens = build_conversation_messages(
+        session_log, system_message, llm_state, rag_chunks=rag_chunks,
+        search_results=search_results if web_search_enabled else None,
+        attachments=attachments, reserve_search=reserve_search and web_search_enabled
+    )
+    return messages, max_tokens
+
+def retrieve_rag_chunks(query, k=3):
+    """Wait for any session restore to finish, then return the session chunks closest to the query."""
+    if not context_injector.wait_until_ready(temporary.RESTORE_WAIT_TIMEOUT):
+        print("Debug: Session restore still running, answering without RAG context")
+    if not context_injector.session_vectorstore or not query.strip():
+        return None
+    docs = context_injector.session_vectorstore.similarity_search(query, k=k)
+    return [doc.page_content for doc in docs]
+
+def start_context_stages(query, attached_files, web_search_enabled=False):
+    """
+    Start a turn's pre-generation stages concurrently, as soon as the input is submitted.
+
+    Args:
+        query (str): The user's input.
+        attached_files (list): Paths of attached files, read into attachment_cache.
+        web_search_enabled (bool): Also run a web search for the query.
+
+    Returns:
+        dict: Stage name to (future, deadline), for collect_context_stages.
+    """
+    from scripts import utility
+    now = time.monotonic()
+    stages = {
+        "rag": (context_executor.submit(retrieve_rag_chunks, query), now + temporary.RAG_STAGE_TIMEOUT),
+        "attachments": (context_executor.submit(attachment_cache.load, list(attached_files)), now + temporary.ATTACH_STAGE_TIMEOUT)
+    }
+    if web_search_enabled:
+        stages["search"] = (context_executor.submit(utility.web_search, query), now + temporary.SEARCH_STAGE_TIMEOUT)
+    return stages
+
+def collect_context_stages(stages, names=None):
+    """
+    Wait for the named stages, each until its own deadline.
+
+    A stage that fails or times out yields None, and the turn goes ahead without it; as all
+    stages started together, the wait is as long as the slowest stage, not the sum.
+
+    Returns:
+        dict: Stage name to result.
+    """
+    results = {}
+    for name, (future, deadline) in stages.items():
+        if names is not None and name not in names:
+            continue
+        try:
+            results[name] = future.result(timeout=max(0.0, deadline - time.monotonic()))
+        except FutureTimeoutError:
+            print(f"Debug: Context stage '{name}' timed out, continuing without it")
+            results[name] = None
+        except Exception as e:
+            print(f"Error in context stage '{name}': {e}")
+            results[name] = None
+    return results
+
+def prefill_prompt(session_log, settings, llm_state, cancel_event=None, stages=None, **prompt_options):
+    """
+    Evaluate the pending turn's prompt into the KV cache on a background thread.
+
+    Started during the afterthought countdown, so the completion that follows shares the
+    whole prompt prefix and can sample straight away. A prefill that is cancelled, or
+    superseded by a newer one or by the generation itself taking the model first, is
+    skipped if it has not started; an evaluated one is simply never sampled from, and
+    the next prompt replaces whatever part of it differs.
+
+    Args:
+        session_log (list): Session messages, ending with the pending user/assistant pair.
+        settings (dict): Model settings from get_model_settings.
+        llm_state: The loaded Llama instance.
+        cancel_event (threading.Event, optional): Set when the turn is cancelled.
+        stages (dict, optional): The turn's context stages; retrieval and attachment reads are
+            awaited, web results are left out as they only extend the newest message, but their
+            share of the budget is reserved so history is trimmed the same way.
+        **prompt_options: disable_think, tot_enabled and web_search_enabled, as for the turn.
+    """
+    global prefill_generation
+    prefill_generation += 1
+    generation = prefill_generation
+    session_log = list(session_log)
+
+    def superseded():
+        return generation != prefill_generation or (cancel_event is not None and cancel_event.is_set())
+
+    def worker():
+        start = time.perf_counter()
+        try:
+            context = collect_context_stages(stages or {}, ["rag", "attachments"])
+            messages, _ = prepare_response_messages(
+                session_log, settings, llm_state, rag_chunks=context.get("rag"),
+                attachments=context.get("attachments"), reserve_search=True, **prompt_options
+            )
+            if messages is None:
+                return
+            with llm_lock:
+                if superseded():
+                    print("Debug: Prompt prefill skipped, turn was cancelled or already answered")
+                    return
+                restore_session_kv_state(llm_state, temporary.current_session_id)
+                llm_state.create_chat_completion(messages=messages, max_tokens=1, temperature=0.0, stream=False)
+            print(f"Debug: Prompt prefill took {(time.perf_counter() - start) * 1000:.0f} ms")
+        except Exception as e:
+            print(f"Warning: Prompt prefill failed: {e}")
+
+    threading.Thread(target=worker, daemon=True).start()
+
+# aSync Functions...
+def get_response_stream(session_log, settings, disable_think=False, tot_enabled=False, 
+                       web_search_enabled=False, search_results=None, cancel_event=None, 
+                       llm_state=None, models_loaded_state=False, rag_chunks=None, attachments=None):
+    global prefill_generation
+    if not models_loaded_state or llm_state is None:
+        yield "Error: No model loaded. Please load a model first."
+        return
+
+    print("Debug: Entering get_response_stream")
+    conversation_cache.last_raw_reply = None
+    generation_stats.clear()
+    print(f"Debug: session_log = {session_log}")
+
+    messages, max_tokens = prepare_response_messages(
+        session_log, settings, llm_state, disable_think=disable_think, tot_enabled=tot_enabled,
+        web_search_enabled=web_search_enabled, search_results=search_results, rag_chunks=rag_chunks,
+        attachments=attachments
+    )
+    if messages is None:
         print("Debug: No valid user message in session_log")
         yield "Error: No user input to process."
         return
@@ -423,67 +1934,103 @@ def get_response_stream(session_log, settings, disable_think=False, tot_enabled=
         print(f"{msg['role'].upper()}:\n{msg['content']}\n")
     print("="*93 + "\n")
 
+    from llama_cpp import LogitsProcessorList
+    stop_reason = []
+    decode = {"tokens": 0, "start": None}
+    draft = llm_state.draft_model if isinstance(getattr(llm_state, "draft_model", None), SpeculativeDraft) else None
+    draft_before = (draft.steps, draft.proposed) if draft else (0, 0)
+
+    def stop_generation(input_ids, scores):
+        """Force end-of-sequence on the next decode step once cancelled or past the timeout.
+
+        The timeout runs from the first sampled token, so prompt prefill does not count.
+        """
+        decode["tokens"] += 1
+        if decode["start"] is None:
+            decode["start"] = time.perf_counter()
+        if not stop_reason:
+            if cancel_event and cancel_event.is_set():
+                stop_reason.append("cancelled")
+            elif temporary.GENERATION_TIMEOUT > 0 and time.perf_counter() - decode["start"] > temporary.GENERATION_TIMEOUT:
+                stop_reason.append("timeout")
+            else:
+                return scores
+            print(f"Debug: Stopping generation ({stop_reason[0]}) after {len(input_ids)} tokens")
+        scores[:] = -np.inf
+        scores[llm_state.token_eos()] = 0.0
+        return scores
+
+    llm_lock.acquire()
     try:
+        prefill_generation += 1  # A countdown prefill still waiting for the lock is now stale
+        restore_session_kv_state(llm_state, temporary.current_session_id)
         print("Debug: Calling llm_state.create_chat_completion")
         response_stream = llm_state.create_chat_completion(
             messages=messages,
-            max_tokens=BATCH_SIZE,
-            temperature=TEMPERATURE,
-            repeat_penalty=REPEAT_PENALTY,
+            max_tokens=max_tokens,
+            temperature=temporary.TEMPERATURE,
+            repeat_penalty=temporary.REPEAT_PENALTY,
+            logits_processor=LogitsProcessorList([stop_generation]),
             stream=True
         )
+        raw_reply = []
+        segmenter = SentenceSegmenter()
+        if temporary.STREAM_MODE == "Token":
+            emit = lambda text: [text] if text else []
+        else:
+            emit = segmenter.feed
         
         if tot_enabled:
             buffer = ""
             in_thought_process = True
+            answer_ended = False
+            emitted = 0
             for chunk in response_stream:
+                if cancel_event and cancel_event.is_set():
+                    yield "<CANCELLED>"
+                    return
                 if 'choices' in chunk and chunk['choices']:
                     content = chunk['choices'][0].get('delta', {}).get('content', '')
-                    if content:
-                        buffer += content
-                        if in_thought_process:
-                            if "<answer>" in buffer:
-                                parts = buffer.split("<answer>", 1)
-                                thought_process = parts[0]
-                                buffer = parts[1]
-                                in_thought_process = False
-                                periods = thought_process.count('.')
-                                for _ in range(periods):
-                                    yield "<TOT_PROGRESS>"
-                                yield "<TOT_ANSWER_START>"
-                            else:
-                                new_periods = content.count('.')
-                                for _ in range(new_periods):
-                                    yield "<TOT_PROGRESS>"
-                        else:
-                            while True:
-                                sentence_end_pos = -1
-                                for i, char in enumerate(buffer):
-                                    if char in ['.', '!', '?']:
-                                        if (i + 1 < len(buffer) and buffer[i + 1].isspace()) or (i + 1 == len(buffer)):
-                                            sentence_end_pos = i
-                                            break
-                                if sentence_end_pos != -1:
-                                    end_pos = sentence_end_pos + 1
-                                    while end_pos < len(buffer) and buffer[end_pos].isspace():
-                                        end_pos += 1
-                                    sentence = buffer[:end_pos]
-                                    buffer = buffer[end_pos:].lstrip()
-                                    if sentence:
-                                        yield sentence
-                                else:
-                                    break
-                            if "</answer>" in buffer:
-                                parts = buffer.split("</answer>", 1)
-                                remaining_answer = parts[0]
-                                if remaining_answer:
-                                    yield remaining_answer
-                                break  # Stop after </answer>
+                    if not content:
+                        continue
+                    buffer += content
+                    if in_thought_process:
+                        answer_pos = find_marker(buffer, "<answer>", len(content))
+                        if answer_pos == -1:
+                            for _ in range(content.count('.')):
+                                yield "<TOT_PROGRESS>"
+                            continue
+                        for _ in range(buffer[len(buffer) - len(content):answer_pos].count('.')):
+                            yield "<TOT_PROGRESS>"
+                        in_thought_process = False
+                        yield "<TOT_ANSWER_START>"
+                        buffer = content = buffer[answer_pos + len("<answer>"):]
+                    end_pos = find_marker(buffer, "</answer>", len(content))
+                    answer_ended = end_pos != -1
+                    # Hold back a tail that could be the start of "</answer>"
+                    safe_end = end_pos if answer_ended else max(len(buffer) - len("</answer>") + 1, emitted)
+                    for piece in emit(buffer[emitted:safe_end]):
+                        yield piece
+                    emitted = safe_end
+                    if answer_ended:
+                        break  # Stop after </answer>
+            if stop_reason == ["cancelled"]:
+                yield "<CANCELLED>"
+                return
+            if not in_thought_process and not answer_ended:
+                for piece in emit(buffer[emitted:]):
+                    yield piece
+            remainder = segmenter.flush()
+            if remainder:
+                yield remainder
+            if stop_reason == ["timeout"]:
+                yield f"\n\n(Stopped after the {temporary.GENERATION_TIMEOUT}s generation timeout.)"
         else:
             buffer = ""
             has_content = False
             in_thinking_phase = settings.get("is_reasoning", False) and not disable_think
-            sentence_endings = ['.', '!', '?']
+            track_raw_reply = not in_thinking_phase
+            thinking_segmenter = SentenceSegmenter()
 
             for chunk in response_stream:
                 if cancel_event and cancel_event.is_set():
@@ -493,52 +2040,45 @@ def get_response_stream(session_log, settings, disable_think=False, tot_enabled=
                     content = chunk['choices'][0].get('delta', {}).get('content', '')
                     if content:
                         has_content = True
-                        buffer += content
+                        raw_reply.append(content)
 
                         if in_thinking_phase:
-                            if "</think>" in buffer:
-                                in_thinking_phase = False
-                                parts = buffer.split("</think>", 1)
-                                buffer = parts[1].strip()
-                                yield "<THINKING_DONE>"
-                                print("Debug: Thinking phase ended")
-                            else:
-                                while True:
-                                    period_pos = buffer.find('.')
-                                    if period_pos != -1 and (period_pos + 1 == len(buffer) or buffer[period_pos + 1] in [' ', '\n']):
-                                        yield "<THINKING_PROGRESS>"
-                                        buffer = buffer[period_pos + 1:].strip()
-                                        print(f"Debug: Yielded <THINKING_PROGRESS> at period position {period_pos}")
-                                    else:
-                                        break
-                        else:
-                            while True:
-                                sentence_end_pos = -1
-                                for i, char in enumerate(buffer):
-                                    if char in sentence_endings:
-                                        if (i + 1 < len(buffer) and buffer[i + 1].isspace() and (i == 0 or not buffer[i - 1].isdigit())) or (i + 1 == len(buffer) and (i == 0 or not buffer[i - 1].isdigit())):
-                                            sentence_end_pos = i
-                                            break
-                                if sentence_end_pos != -1:
-                                    end_pos = sentence_end_pos + 1
-                                    while end_pos < len(buffer) and buffer[end_pos].isspace():
-                                        end_pos += 1
-                                    sentence = buffer[:end_pos]
-                                    buffer = buffer[end_pos:].lstrip()
-                                    if sentence:
-                                        yield sentence
-                                        print(f"Debug: Yielded streaming sentence: {sentence!r}")
-                                else:
-                                    break
-
-            if buffer:
-                yield buffer
-                print(f"Debug: Yielded final streaming buffer: {buffer!r}")
+                            buffer += content
+                            think_end = find_marker(buffer, "</think>", len(content))
+                            if think_end == -1:
+                                for _ in thinking_segmenter.feed(content):
+                                    yield "<THINKING_PROGRESS>"
+                                continue
+                            in_thinking_phase = False
+                            content = buffer[think_end + len("</think>"):].lstrip()
+                            buffer = ""
+                            yield "<THINKING_DONE>"
+                            print("Debug: Thinking phase ended")
+                        for piece in emit(content):
+                            yield piece
+
+            if stop_reason == ["cancelled"]:
+                yield "<CANCELLED>"
+                return
+            if has_content and track_raw_reply and not stop_reason:
+                conversation_cache.last_raw_reply = "".join(raw_reply)
+            remainder = thinking_segmenter.flush() if in_thinking_phase else segmenter.flush()
+            if remainder:
+                yield remainder
+                print(f"Debug: Yielded final streaming buffer: {remainder!r}")
             elif not has_content:
                 print("Debug: Model generated no content")
                 yield "Error: Model generated an empty response."
+            if stop_reason == ["timeout"]:
+                yield f"\n\n(Stopped after the {temporary.GENERATION_TIMEOUT}s generation timeout.)"
+
+        decode_seconds = time.perf_counter() - decode["start"] if decode["start"] else 0.0
+        record_generation_stats(decode["tokens"], decode_seconds, draft, draft_before)
+        save_session_kv_state(llm_state, temporary.current_session_id)
 
     except Exception as e:
         error_msg = f"Error generating response: {str(e)}"
         print(f"Debug: {error_msg}")
-        yield error_msg
\ No newline at end of file
+        yield error_msg
+    finally:
+        llm_lock.release()
\ No newline at end of file
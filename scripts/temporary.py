@@ -9,11 +9,29 @@ MODEL_FOLDER = "path/to/your/models"
 VECTORSTORE_DIR = "data/vectors"
 TEMP_DIR = "data/temp"
 HISTORY_DIR = "data/history"  # Updated to separate from vectors
+SESSION_INDEX_FILE = "data/history/index.json"
+JOURNAL_COMPACT_RATIO = 2  # Compact once journal records exceed this many per live message
+JOURNAL_COMPACT_MIN = 16
+SESSION_STORE = "Journal"  # "SQLite" keeps every session in SESSION_DB_FILE with full-text search, no slot cap
+SESSION_DB_FILE = "data/history/sessions.db"
+MODEL_INFO_CACHE = "data/model_cache.json"
+EMBEDDING_CACHE_DIR = "data/embeddings"
+BLOB_DIR = "data/blobs"  # Content-addressed store for session attach/vector files
 SESSION_FILE_FORMAT = "%Y%m%d_%H%M%S"
 session_label = ""
 current_session_id = None
+session_slot_ids = []  # Session id shown on each history slot button
 RAG_CHUNK_SIZE_DEVIDER = 4
 RAG_CHUNK_OVERLAP_DEVIDER = 32
+EMBEDDING_MODEL = "all-MiniLM-L6-v2"
+EMBEDDING_DEVICE = "cpu"
+EMBEDDING_THREADS = 0  # 0 leaves torch's default thread count
+EMBEDDING_BATCH_SIZE = 32
+RAG_INGEST_BATCH = 64  # Chunks embedded per batch while files are still being chunked
+RAG_INGEST_WORKERS = 0  # 0 uses one worker per CPU core
+VECTOR_SEGMENT_LIMIT = 16  # Vector segments per session store before they are merged into one
+VECTOR_INDEX_TYPE = "Auto"  # "Auto" picks by chunk count using VECTOR_INDEX_THRESHOLDS
+VECTOR_INDEX_THRESHOLDS = {"Flat": 5000, "HNSW": 200000}  # Largest chunk count each type is auto-picked for
 MODELS_LOADED = False
 AVAILABLE_MODELS = None
 SESSION_ACTIVE = False
@@ -31,6 +49,32 @@ DYNAMIC_GPU_LAYERS = True
 MMAP = True
 MLOCK = True
 STREAM_OUTPUT = True
+STREAM_MODE = "Sentence"  # "Token" forwards each token as it arrives instead of whole sentences
+STREAM_FRAME_MS = 50  # Push streamed text to the UI at most once per frame...
+STREAM_FRAME_TOKENS = 16  # ...or once this many pieces have arrived, whichever comes first
+GENERATION_TIMEOUT = 0  # Seconds of decoding, from the first token, before a generation is stopped; 0 for no limit
+READY_CHECK = "decode"  # "decode" samples one token after load, "tokenize" only round-trips the tokenizer
+WARMUP_SYSTEM_PROMPT = True  # Prime the KV cache with the system prompt in the background after load
+COUNTDOWN_PREFILL = True  # Evaluate the full prompt during the afterthought countdown
+SEARCH_STAGE_TIMEOUT = 15  # Seconds from submit that the web search may take before it is skipped
+RAG_STAGE_TIMEOUT = 10  # Same for session retrieval (query embedding and similarity search)
+ATTACH_STAGE_TIMEOUT = 10  # Same for reading attached files
+KV_CACHE_SIZE_MB = 2048  # RAM for saved llama.cpp states, reused across turns by prefix match
+KV_PERSIST = True  # Save each session's llama.cpp state under HISTORY_DIR and restore it on resume
+KV_PERSIST_BUDGET_MB = 4096  # Disk for saved session states; the least recently saved are deleted beyond it
+SPECULATIVE_MODE = "Off"  # "Prompt Lookup" drafts from n-grams already in the context, "Draft Model" from DRAFT_MODEL_NAME
+DRAFT_MODEL_NAME = "None"  # Smaller GGUF in MODEL_FOLDER sharing the main model's vocabulary, run on CPU
+SPECULATIVE_TOKENS = 10  # Tokens drafted per verification step
+
+# Context budget, shares of the context left after the system prompt and generation reserve
+BUDGET_USER_SHARE = 0.6  # Current input may use this much
+BUDGET_ATTACH_SHARE = 0.5  # Attached files, of what remains after the current input
+BUDGET_SEARCH_SHARE = 0.15  # Web results, of what remains after the current input and attachments
+BUDGET_RAG_SHARE = 0.25  # Retrieved chunks, of what remains after the current input and attachments
+BUDGET_TRIM_TARGET = 0.75  # When history overflows, trim it to this fraction so later turns keep their prefix
+BUDGET_MESSAGE_OVERHEAD = 8  # Tokens added per message by chat templates
+ATTACH_INJECT_MODE = "Auto"  # "Auto" sends whole files that fit, else Top-K chunks for the query
+ATTACH_CHUNK_CHARS = 1500  # Line-aligned chunk size for Top-K attachment selection
 USE_PYTHON_BINDINGS = True
 LLAMA_CLI_PATH = "data/llama-vulkan-bin/llama-cli.exe"
 BACKEND_TYPE = "Not Configured"
@@ -45,6 +89,8 @@ llm = None
 # Arrays
 session_attached_files = []
 session_vector_files = []
+session_restore_status = ""
+RESTORE_WAIT_TIMEOUT = 60  # Seconds a RAG query waits for a session restore to finish
 
 # UI Constants
 USER_COLOR = "#ffffff"
@@ -59,6 +105,14 @@ CTX_OPTIONS = [8192, 16384, 24576, 32768, 49152, 65536, 98304, 131072]
 VRAM_OPTIONS = [2048, 3072, 4096, 6144, 8192, 10240, 12288, 16384, 20480, 24576, 32768, 49152, 65536]
 REPEAT_OPTIONS = [1.0, 1.1, 1.2, 1.3, 1.4, 1.5]
 BATCH_OPTIONS = [128, 256, 512, 1024, 2048, 4096]
+READY_CHECK_OPTIONS = ["decode", "tokenize"]
+VECTOR_INDEX_OPTIONS = ["Auto", "Flat", "HNSW", "IVF-PQ"]
+SESSION_STORE_OPTIONS = ["Journal", "SQLite"]
+ATTACH_INJECT_OPTIONS = ["Auto", "Full", "Head/Tail", "Top-K"]
+STREAM_MODE_OPTIONS = ["Sentence", "Token"]
+GENERATION_TIMEOUT_OPTIONS = [0, 120, 300, 600, 1200, 1800]
+SPECULATIVE_OPTIONS = ["Off", "Prompt Lookup", "Draft Model"]
+SPECULATIVE_TOKEN_OPTIONS = [2, 4, 6, 8, 10, 16]
 TEMP_OPTIONS = [0.0, 0.1, 0.25, 0.33, 0.5, 0.66, 0.75, 1.0] 
 MAX_POSSIBLE_HISTORY_SLOTS = 16
 HISTORY_SLOT_OPTIONS = [4, 8, 10, 12, 16]
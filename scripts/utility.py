@@ -1,17 +1,21 @@
 # Script: `.\scripts\utility.py`
 
 # Imports...
-import re, subprocess, json, time, random, psutil, shutil, os, zipfile, yake
+import re, subprocess, json, time, random, psutil, shutil, os, zipfile, yake, uuid, hashlib, sqlite3, threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
 import win32com.client
 import pythoncom
 from pathlib import Path
 from datetime import datetime
 from langchain.text_splitter import RecursiveCharacterTextSplitter
 from langchain_community.document_loaders import TextLoader
-from langchain_huggingface import HuggingFaceEmbeddings
 from langchain_community.vectorstores import FAISS
 from langchain_community.utilities import DuckDuckGoSearchAPIWrapper
-from .models import context_injector, load_models, clean_content  # Updated import
+from .models import (
+    context_injector, load_models, clean_content, get_embeddings,
+    append_vectorstore_delta, export_vectorstore_rows, read_vectorstore_manifest,
+    update_vectorstore_index
+)  # Updated import
 from .temporary import (
     TEMP_DIR, HISTORY_DIR, VECTORSTORE_DIR, SESSION_FILE_FORMAT,
     ALLOWED_EXTENSIONS, current_session_id, session_label, RAG_CHUNK_SIZE_DEVIDER, BATCH_SIZE,
@@ -20,6 +24,16 @@ from .temporary import (
 from . import temporary
 from scripts.models import get_available_models
 
+# Variables...
+session_journals = {}  # session_id -> {"digests", "records", "meta"} for the journal on disk
+session_db = None
+session_db_fts = False
+session_db_lock = threading.RLock()
+session_restore_generation = 0
+session_restore_lock = threading.Lock()
+blob_lock = threading.Lock()
+session_save_lock = threading.Lock()
+
 # Functions...
 def filter_operational_content(text):
     """Remove operational tags and metadata from the text."""
@@ -99,29 +113,435 @@ def generate_session_label(session_log):
         description = description[:25]
     return description
 
+def session_journal_path(session_id):
+    return Path(HISTORY_DIR) / f"session_{session_id}.jsonl"
+
+def message_digest(message):
+    return hashlib.blake2b(json.dumps(message, sort_keys=True).encode("utf-8"), digest_size=8).hexdigest()
+
+def make_meta_record(session_id, label, attached_files, vector_files):
+    return {"type": "meta", "session_id": session_id, "label": label,
+            "attached_files": list(attached_files or []), "vector_files": list(vector_files or [])}
+
+def append_journal_records(journal_path, records):
+    """Append records as JSON lines and fsync, so a completed save survives a crash."""
+    with open(journal_path, "a", encoding="utf-8") as f:
+        for record in records:
+            f.write(json.dumps(record) + "\n")
+        f.flush()
+        os.fsync(f.fileno())
+
+def compact_session_journal(session_id, label, session_log, attached_files, vector_files):
+    """Rewrite a session journal as one snapshot, swapped in atomically via rename."""
+    journal_path = session_journal_path(session_id)
+    tmp_path = journal_path.with_suffix(".tmp")
+    meta = make_meta_record(session_id, label, attached_files, vector_files)
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        f.write(json.dumps(meta) + "\n")
+        for msg in session_log:
+            f.write(json.dumps({"type": "message", "message": msg}) + "\n")
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, journal_path)
+    legacy_file = Path(HISTORY_DIR) / f"session_{session_id}.json"
+    if legacy_file.exists():
+        legacy_file.unlink()
+    session_journals[session_id] = {
+        "digests": [message_digest(msg) for msg in session_log],
+        "records": len(session_log) + 1,
+        "meta": meta
+    }
+    print(f"Debug: Compacted journal for session {session_id} ({len(session_log)} messages)")
+
+def read_session_journal(journal_path):
+    """
+    Replay a session journal into the session JSON layout.
+
+    Args:
+        journal_path (Path): Path to the session .jsonl journal.
+
+    Returns:
+        dict: session_id, label, history, attached_files and vector_files.
+    """
+    data = {"session_id": journal_path.stem.replace('session_', ''), "label": "Untitled",
+            "history": [], "attached_files": [], "vector_files": []}
+    records = 0
+    torn = False
+    with open(journal_path, "r", encoding="utf-8") as f:
+        for line in f:
+            try:
+                if not line.endswith("\n"):
+                    raise ValueError("unterminated record")
+                record = json.loads(line)
+            except ValueError:
+                print(f"Ignoring torn journal record in {journal_path}")
+                torn = True
+                break
+            records += 1
+            if record["type"] == "meta":
+                data.update({k: v for k, v in record.items() if k != "type"})
+            elif record["type"] == "message":
+                data["history"].append(record["message"])
+            elif record["type"] == "truncate":
+                del data["history"][record["length"]:]
+    if torn:
+        # Leave the journal untracked so the next save compacts it instead of appending after the torn tail
+        session_journals.pop(data["session_id"], None)
+        return data
+    session_journals[data["session_id"]] = {
+        "digests": [message_digest(msg) for msg in data["history"]],
+        "records": records,
+        "meta": make_meta_record(data["session_id"], data["label"], data["attached_files"], data["vector_files"])
+    }
+    return data
+
+def read_session_file(session_file):
+    """Load a session from either a journal (.jsonl) or a legacy/exported JSON file."""
+    session_file = Path(session_file)
+    if session_file.suffix == ".jsonl":
+        return read_session_journal(session_file)
+    with open(session_file, "r") as f:
+        return json.load(f)
+
+def export_session_json(session_id, export_path=None):
+    """Write a session out in the single-file JSON format, from whichever store holds it."""
+    data = read_session_db(session_id) if temporary.SESSION_STORE == "SQLite" else None
+    if data is None:
+        journal_path = session_journal_path(session_id)
+        if not journal_path.exists():
+            raise FileNotFoundError(f"Session {session_id} has not been saved")
+        data = read_session_journal(journal_path)
+    export_path = Path(export_path) if export_path else Path(HISTORY_DIR) / f"session_{session_id}_export.json"
+    with open(export_path, "w") as f:
+        json.dump(data, f)
+    return str(export_path)
+
 # Updated save_session_history
-def save_session_history(session_log, attached_files, vector_files):
-    """Save or update session history with a YAKE-generated label."""
+def save_session_history(session_log, attached_files=None, vector_files=None, session_id=None):
+    """
+    Append the changed turns of the session to its journal, with a YAKE-generated label.
+
+    The file lists default to the session's current files. They are read only after any
+    running session restore has installed them, so a save during a restore never records
+    empty lists or releases the session's blobs; if the restore outlasts
+    RESTORE_WAIT_TIMEOUT the save is queued until it finishes. This blocks, so call it
+    through asyncio.to_thread from the event loop.
+    """
     if not temporary.current_session_id:
         temporary.current_session_id = generate_session_id()
-    temporary.session_label = generate_session_label(session_log)
+    session_id = session_id or temporary.current_session_id
+    if not context_injector.wait_until_ready(temporary.RESTORE_WAIT_TIMEOUT):
+        print("Debug: Session restore still running, saving the turn once it finishes")
+        pending_log = [dict(msg) for msg in session_log]
+
+        def save_when_restored():
+            context_injector.ready.wait()
+            save_session_history(pending_log, attached_files, vector_files, session_id)
+
+        threading.Thread(target=save_when_restored, daemon=True).start()
+        return
+    with session_save_lock:
+        if session_id != temporary.current_session_id:
+            # Another session was loaded meanwhile; keep the files this one was last saved with
+            manifest = read_json_file(blob_manifest_path(session_id), {"attach": [], "vector": []})
+            write_session_history(session_log, session_id,
+                                  [entry["path"] for entry in manifest["attach"]],
+                                  [entry["path"] for entry in manifest["vector"]], store_files=False)
+        else:
+            write_session_history(session_log, session_id, attached_files, vector_files)
+
+def write_session_history(session_log, session_id, attached_files, vector_files, store_files=True):
+    """Write one save of a session to the configured store; the caller holds session_save_lock."""
+    if attached_files is None:
+        attached_files = temporary.session_attached_files
+    if vector_files is None:
+        vector_files = temporary.session_vector_files
+    label = generate_session_label(session_log)
+    if session_id == temporary.current_session_id:
+        temporary.session_label = label
     os.makedirs(HISTORY_DIR, exist_ok=True)
-    session_file = Path(HISTORY_DIR) / f"session_{temporary.current_session_id}.json"
-    session_data = {
-        "session_id": temporary.current_session_id,
-        "label": temporary.session_label,
-        "history": session_log,
-        "attached_files": attached_files,
-        "vector_files": vector_files if vector_files else []
-    }
-    with open(session_file, "w") as f:
-        json.dump(session_data, f)
+    try:
+        if store_files:
+            store_session_files(session_id, attached_files, vector_files)
+    except Exception as e:
+        print(f"Error storing session files for {session_id}: {e}")
+    if temporary.SESSION_STORE == "SQLite":
+        save_session_db(session_id, label, session_log, attached_files, vector_files)
+        return
+    journal_path = session_journal_path(session_id)
+    journal = session_journals.get(session_id)
+    if journal is None or not journal_path.exists():
+        compact_session_journal(session_id, label, session_log, attached_files, vector_files)
+    else:
+        digests = [message_digest(msg) for msg in session_log]
+        keep = 0
+        while keep < min(len(digests), len(journal["digests"])) and digests[keep] == journal["digests"][keep]:
+            keep += 1
+        records = []
+        if keep < len(journal["digests"]):
+            records.append({"type": "truncate", "length": keep})
+        meta = make_meta_record(session_id, label, attached_files, vector_files)
+        if meta != journal["meta"]:
+            records.append(meta)
+        records.extend({"type": "message", "message": msg} for msg in session_log[keep:])
+        if records:
+            append_journal_records(journal_path, records)
+        journal.update(digests=digests, records=journal["records"] + len(records), meta=meta)
+        if journal["records"] > len(session_log) * temporary.JOURNAL_COMPACT_RATIO + temporary.JOURNAL_COMPACT_MIN:
+            compact_session_journal(session_id, label, session_log, attached_files, vector_files)
+    update_session_index(session_id, journal_path.name, label,
+                         session_log, attached_files, vector_files)
     manage_session_history()
+
+def load_session_index():
+    """Read the session index, rebuilding it from the session files if it is missing."""
+    index_path = Path(temporary.SESSION_INDEX_FILE)
+    try:
+        with open(index_path, "r") as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return rebuild_session_index()
+    except Exception as e:
+        print(f"Error reading session index, rebuilding: {e}")
+        return rebuild_session_index()
+
+def write_session_index(index):
+    index_path = Path(temporary.SESSION_INDEX_FILE)
+    index_path.parent.mkdir(parents=True, exist_ok=True)
+    tmp_path = index_path.with_suffix(".tmp")
+    with open(tmp_path, "w") as f:
+        json.dump(index, f)
+    os.replace(tmp_path, index_path)
+
+def make_session_index_entry(session_file, label, history, attached_files, vector_files, mtime):
+    return {
+        "file": session_file,
+        "label": label,
+        "mtime": mtime,
+        "turns": sum(1 for msg in history if msg.get('role') == 'user'),
+        "attached": len(attached_files or []),
+        "vectors": len(vector_files or [])
+    }
+
+def rebuild_session_index():
+    """Recreate the index by parsing each session file once, without extracting any attachments."""
+    index = {}
+    session_files = [f for f in Path(HISTORY_DIR).glob("session_*.json*") if f.suffix in (".json", ".jsonl")
+                     and not f.stem.endswith("_export")]
+    for session_file in session_files:
+        try:
+            data = read_session_file(session_file)
+            session_id = data.get("session_id", session_file.stem.replace('session_', ''))
+            index[session_id] = make_session_index_entry(
+                session_file.name, data.get("label", "Untitled"), data.get("history", []),
+                data.get("attached_files", []), data.get("vector_files", []), session_file.stat().st_mtime
+            )
+        except Exception as e:
+            print(f"Error indexing session file {session_file}: {e}")
+    write_session_index(index)
+    print(f"Rebuilt session index with {len(index)} sessions")
+    return index
+
+def update_session_index(session_id, session_file, label, history, attached_files, vector_files):
+    index = load_session_index()
+    index[session_id] = make_session_index_entry(session_file, label, history, attached_files, vector_files, time.time())
+    write_session_index(index)
+
+def get_session_entries(query="", limit=None):
+    """
+    Return saved sessions newest first, optionally filtered by a search query.
+
+    Args:
+        query (str): Text to search for; full-text over turns with the SQLite store, labels otherwise.
+        limit (int): Maximum number of entries, or None for all.
+
+    Returns:
+        list: Entry dicts with session_id, label, mtime, turns, attached and vectors.
+    """
+    if temporary.SESSION_STORE == "SQLite":
+        return search_session_db(query, limit) if query.strip() else list_session_db(limit)
+    index = load_session_index()
+    entries = [dict(entry, session_id=session_id) for session_id, entry in index.items()
+               if query.lower() in entry["label"].lower()]
+    return sorted(entries, key=lambda e: e["mtime"], reverse=True)[:limit]
+
+def get_session_db():
+    """Open the SQLite session store once, creating the schema and importing file sessions on first use."""
+    global session_db, session_db_fts
+    if session_db is not None:
+        return session_db
+    os.makedirs(Path(temporary.SESSION_DB_FILE).parent, exist_ok=True)
+    conn = sqlite3.connect(temporary.SESSION_DB_FILE, check_same_thread=False)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.executescript("""
+        CREATE TABLE IF NOT EXISTS sessions (
+            session_id TEXT PRIMARY KEY, label TEXT, updated REAL, turns INTEGER,
+            attached_files TEXT, vector_files TEXT);
+        CREATE TABLE IF NOT EXISTS turns (
+            session_id TEXT, idx INTEGER, role TEXT, content TEXT, digest TEXT,
+            PRIMARY KEY (session_id, idx));
+        CREATE INDEX IF NOT EXISTS sessions_updated ON sessions (updated);
+    """)
+    try:
+        conn.executescript("""
+            CREATE VIRTUAL TABLE IF NOT EXISTS turns_fts USING fts5(content, content='turns', content_rowid='rowid');
+            CREATE TRIGGER IF NOT EXISTS turns_ai AFTER INSERT ON turns BEGIN
+                INSERT INTO turns_fts(rowid, content) VALUES (new.rowid, new.content);
+            END;
+            CREATE TRIGGER IF NOT EXISTS turns_ad AFTER DELETE ON turns BEGIN
+                INSERT INTO turns_fts(turns_fts, rowid, content) VALUES ('delete', old.rowid, old.content);
+            END;
+        """)
+        session_db_fts = True
+    except sqlite3.OperationalError as e:
+        print(f"FTS5 unavailable, history search falls back to LIKE: {e}")
+    session_db = conn
+    if conn.execute("SELECT COUNT(*) FROM sessions").fetchone()[0] == 0:
+        import_sessions_to_db()
+    return session_db
+
+def save_session_db(session_id, label, session_log, attached_files, vector_files):
+    """Upsert a session, rewriting only the turns from the first changed message onwards."""
+    digests = [message_digest(msg) for msg in session_log]
+    with session_db_lock:
+        conn = get_session_db()
+        stored = [row[0] for row in conn.execute(
+            "SELECT digest FROM turns WHERE session_id = ? ORDER BY idx", (session_id,))]
+        keep = 0
+        while keep < min(len(digests), len(stored)) and digests[keep] == stored[keep]:
+            keep += 1
+        with conn:
+            conn.execute("DELETE FROM turns WHERE session_id = ? AND idx >= ?", (session_id, keep))
+            conn.executemany(
+                "INSERT INTO turns (session_id, idx, role, content, digest) VALUES (?, ?, ?, ?, ?)",
+                [(session_id, i, msg['role'], msg['content'], digests[i])
+                 for i, msg in enumerate(session_log) if i >= keep]
+            )
+            conn.execute(
+                "INSERT OR REPLACE INTO sessions VALUES (?, ?, ?, ?, ?, ?)",
+                (session_id, label, time.time(), sum(1 for msg in session_log if msg['role'] == 'user'),
+                 json.dumps(attached_files or []), json.dumps(vector_files or []))
+            )
+
+def read_session_db(session_id):
+    """Return a session from the SQLite store in the session JSON layout, or None if absent."""
+    with session_db_lock:
+        conn = get_session_db()
+        row = conn.execute("SELECT label, attached_files, vector_files FROM sessions WHERE session_id = ?",
+                           (session_id,)).fetchone()
+        if row is None:
+            return None
+        history = [{"role": role, "content": content} for role, content in conn.execute(
+            "SELECT role, content FROM turns WHERE session_id = ? ORDER BY idx", (session_id,))]
+    return {"session_id": session_id, "label": row[0], "history": history,
+            "attached_files": json.loads(row[1]), "vector_files": json.loads(row[2])}
+
+def session_db_entry(row):
+    session_id, label, updated, turns, attached_files, vector_files = row
+    return {"session_id": session_id, "label": label, "mtime": updated, "turns": turns,
+            "attached": len(json.loads(attached_files)), "vectors": len(json.loads(vector_files))}
+
+def list_session_db(limit=None):
+    with session_db_lock:
+        rows = get_session_db().execute(
+            "SELECT * FROM sessions ORDER BY updated DESC LIMIT ?", (limit if limit else -1,)).fetchall()
+    return [session_db_entry(row) for row in rows]
+
+def search_session_db(query, limit=None):
+    """Find sessions whose turns match the query, best match first."""
+    with session_db_lock:
+        conn = get_session_db()
+        if session_db_fts:
+            match = " ".join('"{}"*'.format(term.replace('"', '""')) for term in query.split())
+            rows = conn.execute("""
+                SELECT s.* FROM turns_fts JOIN turns t ON t.rowid = turns_fts.rowid
+                JOIN sessions s ON s.session_id = t.session_id
+                WHERE turns_fts MATCH ? ORDER BY turns_fts.rank""", (match,)).fetchall()
+        else:
+            rows = conn.execute("""
+                SELECT s.* FROM turns t JOIN sessions s ON s.session_id = t.session_id
+                WHERE t.content LIKE ? ORDER BY s.updated DESC""", (f"%{query.strip()}%",)).fetchall()
+    entries, seen = [], set()
+    for row in rows:
+        if row[0] not in seen:
+            seen.add(row[0])
+            entries.append(session_db_entry(row))
+    return entries[:limit]
+
+def import_sessions_to_db():
+    """Copy the file-based sessions into a freshly created SQLite store."""
+    index = load_session_index()
+    for session_id, entry in index.items():
+        try:
+            data = read_session_file(Path(HISTORY_DIR) / entry["file"])
+            save_session_db(session_id, data.get("label", "Untitled"), data.get("history", []),
+                            data.get("attached_files", []), data.get("vector_files", []))
+            session_db.execute("UPDATE sessions SET updated = ? WHERE session_id = ?", (entry["mtime"], session_id))
+        except Exception as e:
+            print(f"Error importing session {session_id}: {e}")
+    session_db.commit()
+    print(f"Imported {len(index)} sessions into {temporary.SESSION_DB_FILE}")
+
+def load_session(session_id, defer_files=False):
+    """Load a session by id from whichever store holds it."""
+    if temporary.SESSION_STORE == "SQLite":
+        data = read_session_db(session_id)
+        if data is not None:
+            return restore_session_data(data, session_id, defer_files)
+    entry = load_session_index().get(session_id)
+    if entry is None:
+        print(f"Session {session_id} not found")
+        return None, "Error", [], [], []
+    return load_session_history(Path(HISTORY_DIR) / entry["file"], defer_files)
+
+def start_session_restore(session_id, attached_files, vector_files):
+    """
+    Hydrate a session's attachments, vector files and vectorstore on a background thread.
+
+    The context injector stays not-ready until the restore installs its results, so the
+    first RAG query waits for it. A restore superseded by another session load, or by
+    cancel_session_restore, discards its results.
+    """
+    global session_restore_generation
+    with session_restore_lock:
+        session_restore_generation += 1
+        generation = session_restore_generation
+        context_injector.ready.clear()
+        temporary.session_restore_status = "Restoring session files..."
+
+    def restore():
+        try:
+            restored_attach, restored_vector = hydrate_session_files(session_id, attached_files, vector_files)
+            with session_restore_lock:
+                if generation != session_restore_generation:
+                    return
+                temporary.session_restore_status = "Loading session vectorstore..."
+            vectorstore = context_injector.read_session_vectorstore(session_id)
+        except Exception as e:
+            print(f"Error restoring session {session_id}: {e}")
+            restored_attach, restored_vector, vectorstore = [], [], None
+        with session_restore_lock:
+            if generation != session_restore_generation:
+                return
+            temporary.session_attached_files = restored_attach
+            temporary.session_vector_files = restored_vector
+            context_injector.set_session_vectorstore(vectorstore)
+            temporary.session_restore_status = f"Session restored: {len(restored_attach)} attached, {len(restored_vector)} vector files."
+            context_injector.ready.set()
+
+    threading.Thread(target=restore, daemon=True).start()
+
+def cancel_session_restore():
+    """Abandon any running session restore and mark the context injector ready."""
+    global session_restore_generation
+    with session_restore_lock:
+        session_restore_generation += 1
+        context_injector.ready.set()
     
 def load_session_history(session_file):
     try:
-        with open(session_file, "r") as f:
-            data = json.load(f)
+        data = read_session_file(session_file)
     except Exception as e:
         print(f"Error loading session file {session_file}: {e}")
         return None, "Error", [], [], []
@@ -158,22 +578,165 @@ def load_session_history(session_file):
 
     return session_id, label, history, attached_files, vector_files
 
-def zip_session_files(session_id, attached_files, vector_files):
-    temp_dir = Path(TEMP_DIR) / f"session_{session_id}"
-    vector_dir = Path(VECTORSTORE_DIR)  # Change to VECTORSTORE_DIR
-    os.makedirs(vector_dir, exist_ok=True)
-    if temp_dir.exists():
-        attach_zip = Path(TEMP_DIR) / f"session_{session_id}_attach.zip"
-        vector_zip = vector_dir / f"session_{session_id}_vector.zip"  # Updated path
-        if attached_files:
-            with zipfile.ZipFile(attach_zip, "w", zipfile.ZIP_DEFLATED) as zf:
-                for file in attached_files:
-                    zf.write(file, Path(file).name)
-        if vector_files:
-            with zipfile.ZipFile(vector_zip, "w", zipfile.ZIP_DEFLATED) as zf:
-                for file in vector_files:
-                    zf.write(file, Path(file).name)
-        shutil.rmtree(temp_dir, ignore_errors=True)
+def file_digest(file_path):
+    digest = hashlib.blake2b(digest_size=20)
+    with open(file_path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+def blob_path(digest):
+    return Path(temporary.BLOB_DIR) / digest[:2] / digest
+
+def blob_manifest_path(session_id):
+    return Path(temporary.BLOB_DIR) / "sessions" / f"session_{session_id}.json"
+
+def read_json_file(file_path, default):
+    try:
+        with open(file_path, "r") as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return default
+
+def write_json_file(file_path, data):
+    file_path = Path(file_path)
+    file_path.parent.mkdir(parents=True, exist_ok=True)
+    tmp_path = file_path.with_suffix(".tmp")
+    with open(tmp_path, "w") as f:
+        json.dump(data, f)
+    os.replace(tmp_path, file_path)
+
+def put_blob(file_path):
+    """Copy a file into the blob store under its content hash, unless that content is already there."""
+    digest = file_digest(file_path)
+    target = blob_path(digest)
+    if not target.exists():
+        target.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = target.with_suffix(".tmp")
+        shutil.copyfile(file_path, tmp_path)
+        os.replace(tmp_path, target)
+    return digest
+
+def store_session_files(session_id, attached_files, vector_files):
+    """
+    Record a session's attach and vector files in the blob store.
+
+    Files unchanged since the last save (same path, size and mtime) are not re-read, and
+    content already stored for any session is not written again. refs.json maps each blob
+    hash to the sessions that use it.
+    """
+    with blob_lock:
+        manifest_path = blob_manifest_path(session_id)
+        old_manifest = read_json_file(manifest_path, {"attach": [], "vector": []})
+        known = {entry["path"]: entry for entry in old_manifest["attach"] + old_manifest["vector"]}
+        manifest = {}
+        for kind, files in (("attach", attached_files), ("vector", vector_files)):
+            entries = []
+            for file in files or []:
+                try:
+                    stat = os.stat(file)
+                except OSError:
+                    print(f"Skipping missing session file: {file}")
+                    continue
+                entry = known.get(str(file))
+                if (not entry or entry["size"] != stat.st_size or entry["mtime"] != stat.st_mtime
+                        or not blob_path(entry["hash"]).exists()):
+                    entry = {"path": str(file), "name": Path(file).name, "size": stat.st_size,
+                             "mtime": stat.st_mtime, "hash": put_blob(file)}
+                entries.append(entry)
+            manifest[kind] = entries
+        if manifest == old_manifest:
+            return
+        write_json_file(manifest_path, manifest)
+        old_hashes = {entry["hash"] for entry in old_manifest["attach"] + old_manifest["vector"]}
+        new_hashes = {entry["hash"] for entry in manifest["attach"] + manifest["vector"]}
+        refs_path = Path(temporary.BLOB_DIR) / "refs.json"
+        refs = read_json_file(refs_path, {})
+        for digest in new_hashes - old_hashes:
+            refs.setdefault(digest, []).append(session_id)
+        for digest in old_hashes - new_hashes:
+            release_blob_ref(refs, digest, session_id)
+        write_json_file(refs_path, refs)
+
+def release_blob_ref(refs, digest, session_id):
+    """Drop one session's reference to a blob, deleting the blob when nothing references it."""
+    sessions = refs.get(digest, [])
+    if session_id in sessions:
+        sessions.remove(session_id)
+    if not sessions:
+        refs.pop(digest, None)
+        blob_path(digest).unlink(missing_ok=True)
+
+def release_session_files(session_id):
+    """Forget a deleted session's files, removing blobs no other session uses."""
+    with blob_lock:
+        manifest_path = blob_manifest_path(session_id)
+        manifest = read_json_file(manifest_path, None)
+        if manifest is None:
+            return
+        refs_path = Path(temporary.BLOB_DIR) / "refs.json"
+        refs = read_json_file(refs_path, {})
+        for digest in {entry["hash"] for entry in manifest["attach"] + manifest["vector"]}:
+            release_blob_ref(refs, digest, session_id)
+        write_json_file(refs_path, refs)
+        manifest_path.unlink(missing_ok=True)
+
+def restore_session_blobs(session_id):
+    """
+    Materialise a session's files under TEMP_DIR from the blob store.
+
+    Files are written as copies, never hard links, so later writes to them cannot alter the
+    shared blob. Each copy's hash, size and mtime go in a restored.json beside the files; a
+    later restore keeps a file whose size and mtime still match that record without reading
+    it, so reloading a session only copies what is missing or was changed.
+
+    Args:
+        session_id (str): Session whose blob manifest to restore.
+
+    Returns:
+        tuple: (attached_files, vector_files), or None if the session has no blob manifest.
+    """
+    manifest = read_json_file(blob_manifest_path(session_id), None)
+    if manifest is None:
+        return None
+    session_dir = Path(TEMP_DIR) / f"session_{session_id}"
+    record_path = session_dir / "restored.json"
+    record = read_json_file(record_path, {})
+    restored = {"attach": [], "vector": []}
+    changed = False
+    for kind in restored:
+        for entry in manifest[kind]:
+            dest = session_dir / kind / entry["name"]
+            written = record.get(str(dest))
+            try:
+                stat = dest.stat()
+                intact = (written is not None and written["hash"] == entry["hash"]
+                          and written["size"] == stat.st_size and written["mtime"] == stat.st_mtime)
+            except FileNotFoundError:
+                intact = False
+            if not intact:
+                dest.parent.mkdir(parents=True, exist_ok=True)
+                tmp_path = dest.with_name(dest.name + ".tmp")
+                shutil.copyfile(blob_path(entry["hash"]), tmp_path)
+                os.replace(tmp_path, dest)  # Replaces the entry, so an old hard link's blob is left intact
+                stat = dest.stat()
+                record[str(dest)] = {"hash": entry["hash"], "size": stat.st_size, "mtime": stat.st_mtime}
+                changed = True
+            restored[kind].append(str(dest))
+    if changed:
+        write_json_file(record_path, record)
+    return restored["attach"], restored["vector"]
+
+def collect_blob_garbage():
+    """Delete blobs that no session references, including leftovers from interrupted saves."""
+    with blob_lock:
+        refs = read_json_file(Path(temporary.BLOB_DIR) / "refs.json", {})
+        removed = 0
+        for blob in Path(temporary.BLOB_DIR).glob("??/*"):
+            if blob.name not in refs:
+                blob.unlink(missing_ok=True)
+                removed += 1
+    print(f"Removed {removed} unreferenced blobs")
 
 def unzip_session_files(session_id):
     temp_dir = Path(TEMP_DIR) / f"session_{session_id}"
@@ -186,50 +749,73 @@ def unzip_session_files(session_id):
         with zipfile.ZipFile(vector_zip, "r") as zf:
             zf.extractall(temp_dir / "vector")
 
+def hydrate_session_files(session_id, attached_files, vector_files):
+    """Restore a session's saved files into TEMP_DIR and return the restored file lists."""
+    try:
+        restored = restore_session_blobs(session_id)
+        if restored is not None:
+            return restored
+        unzip_session_files(session_id)  # Sessions saved before the blob store
+        attach_dir = Path(TEMP_DIR) / f"session_{session_id}" / "attach"
+        vector_dir = Path(TEMP_DIR) / f"session_{session_id}" / "vector"
+        if attach_dir.exists():
+            attached_files = [str(f) for f in attach_dir.glob("*") if f.is_file()]
+        if vector_dir.exists():
+            vector_files = [str(f) for f in vector_dir.glob("*") if f.is_file()]
+        else:
+            vector_files = []  # Empty list if no vector directory
+    except Exception as e:
+        print(f"Error unzipping session files for {session_id}: {e}")
+    return attached_files, vector_files
+
 def manage_session_history():
     """Limit saved sessions to MAX_HISTORY_SLOTS."""
-    history_dir = Path(HISTORY_DIR)
-    session_files = sorted(history_dir.glob("session_*.json"), key=lambda x: x.stat().st_mtime, reverse=True)
-    while len(session_files) > temporary.MAX_HISTORY_SLOTS:
-        oldest_file = session_files.pop()
-        oldest_file.unlink()
+    if temporary.SESSION_STORE == "SQLite":
+        return
+    entries = get_session_entries()
+    if len(entries) <= temporary.MAX_HISTORY_SLOTS:
+        return
+    index = load_session_index()
+    for entry in entries[temporary.MAX_HISTORY_SLOTS:]:
+        oldest_file = Path(HISTORY_DIR) / entry["file"]
+        oldest_file.unlink(missing_ok=True)
+        (Path(HISTORY_DIR) / f"kv_{entry['session_id']}.state").unlink(missing_ok=True)
+        index.pop(entry["session_id"], None)
+        release_session_files(entry["session_id"])
         print(f"Deleted oldest session: {oldest_file}")
+    write_session_index(index)
         
-def load_session_history(session_file):
+def load_session_history(session_file, defer_files=False):
     """
     Load session history from a JSON file, returning five values with defaults for missing keys.
 
     Args:
         session_file (Path): Path to the session JSON file.
+        defer_files (bool): Skip unzipping attachments and vector files, leaving them to start_session_restore.
 
     Returns:
         tuple: (session_id, label, history, attached_files, vector_files)
     """
     try:
-        with open(session_file, "r") as f:
-            data = json.load(f)
+        data = read_session_file(session_file)
     except Exception as e:
         print(f"Error loading session file {session_file}: {e}")
         return None, "Error", [], [], []  # Always return 5 values
+    return restore_session_data(data, session_file.stem.replace('session_', ''), defer_files)
 
-    session_id = data.get("session_id", session_file.stem.replace('session_', ''))
+def restore_session_data(data, default_session_id, defer_files=False):
+    """Unpack a loaded session's data and restore its attached and vector files."""
+    session_id = data.get("session_id", default_session_id)
     label = data.get("label", "Untitled")
     history = data.get("history", [])
     attached_files = data.get("attached_files", [])
     vector_files = data.get("vector_files", [])
 
-    try:
-        unzip_session_files(session_id)
-        attach_dir = Path(TEMP_DIR) / f"session_{session_id}" / "attach"
-        vector_dir = Path(TEMP_DIR) / f"session_{session_id}" / "vector"
-        if attach_dir.exists():
-            attached_files = [str(f) for f in attach_dir.glob("*") if f.is_file()]
-        if vector_dir.exists():
-            vector_files = [str(f) for f in vector_dir.glob("*") if f.is_file()]
-        else:
-            vector_files = []  # Empty list if no vector directory
-    except Exception as e:
-        print(f"Error unzipping session files for {session_id}: {e}")
+    if defer_files:
+        temporary.session_attached_files = []
+        temporary.session_vector_files = []
+        return session_id, label, history, attached_files, vector_files
+    attached_files, vector_files = hydrate_session_files(session_id, attached_files, vector_files)
 
     temporary.session_attached_files = attached_files
     temporary.session_vector_files = vector_files
@@ -286,36 +872,113 @@ def get_attached_files_summary(attached_files):
         summary_list.append(f"**{Path(file).name}** - {summary}")
     return "\n".join(summary_list)
 
+def get_rag_splitter():
+    """Build the chunk splitter for the current context size; it is stateless and shared by workers."""
+    chunk_size = temporary.CONTEXT_SIZE // (RAG_CHUNK_SIZE_DEVIDER if RAG_CHUNK_SIZE_DEVIDER != 0 else 4)
+    chunk_overlap = temporary.CONTEXT_SIZE // (RAG_CHUNK_OVERLAP_DEVIDER if RAG_CHUNK_OVERLAP_DEVIDER != 0 else 32)
+    return RecursiveCharacterTextSplitter(chunk_size=chunk_size, chunk_overlap=chunk_overlap)
+
+def chunk_document(file_path, splitter):
+    """Load and chunk a single file."""
+    loader = TextLoader(file_path, encoding="utf-8", autodetect_encoding=True)
+    return splitter.split_documents(loader.load())
+
+def iter_document_chunks(file_paths: list, batch_size=None):
+    """
+    Chunk files in a worker pool and yield fixed-size chunk batches as files finish.
+
+    A file that fails to load is reported and skipped without affecting the others.
+
+    Yields:
+        tuple: (chunks, files_done, files_total, errors); chunks is empty on progress-only
+        updates and the last batch may be short.
+    """
+    batch_size = batch_size or temporary.RAG_INGEST_BATCH
+    files = [f for f in file_paths if Path(f).suffix[1:].lower() in ALLOWED_EXTENSIONS]
+    splitter = get_rag_splitter()
+    workers = temporary.RAG_INGEST_WORKERS or os.cpu_count() or 4
+    errors = []
+    pending = []
+    files_done = 0
+    if not files:
+        return
+    with ThreadPoolExecutor(max_workers=min(workers, len(files))) as pool:
+        futures = {pool.submit(chunk_document, f, splitter): f for f in files}
+        for future in as_completed(futures):
+            files_done += 1
+            try:
+                pending.extend(future.result())
+            except Exception as e:
+                errors.append(Path(futures[future]).name)
+                print(f"Error loading document {futures[future]}: {e}")
+            if len(pending) < batch_size:
+                yield [], files_done, len(files), errors  # Progress only
+            while len(pending) >= batch_size:
+                yield pending[:batch_size], files_done, len(files), errors
+                pending = pending[batch_size:]
+    yield pending, files_done, len(files), errors
+
 def load_and_chunk_documents(file_paths: list) -> list:
     """Load and chunk documents from a list of file paths for RAG."""
-    from langchain.text_splitter import RecursiveCharacterTextSplitter
-    from langchain_community.document_loaders import TextLoader
-    from .temporary import CONTEXT_SIZE, RAG_CHUNK_SIZE_DEVIDER, RAG_CHUNK_OVERLAP_DEVIDER
     documents = []
-    try:
-        chunk_size = CONTEXT_SIZE // (RAG_CHUNK_SIZE_DEVIDER if RAG_CHUNK_SIZE_DEVIDER != 0 else 4)
-        chunk_overlap = CONTEXT_SIZE // (RAG_CHUNK_OVERLAP_DEVIDER if RAG_CHUNK_OVERLAP_DEVIDER != 0 else 32)
-        for file_path in file_paths:
-            if Path(file_path).suffix[1:].lower() in ALLOWED_EXTENSIONS:
-                loader = TextLoader(file_path)
-                docs = loader.load()
-                splitter = RecursiveCharacterTextSplitter(chunk_size=chunk_size, chunk_overlap=chunk_overlap)
-                chunks = splitter.split_documents(docs)
-                documents.extend(chunks)
-    except Exception as e:
-        print(f"Error loading documents: {e}")
+    for chunks, _, _, _ in iter_document_chunks(file_paths):
+        documents.extend(chunks)
     return documents
 
+def stream_session_vectorstore(file_paths, session_id, vectorstore=None):
+    """
+    Embed files into a session vectorstore batch by batch, reporting progress.
+
+    Args:
+        file_paths (list): Files to ingest.
+        session_id (str): Session the store belongs to.
+        vectorstore (FAISS, optional): Existing store to extend; a new one is built if None.
+
+    Yields:
+        tuple: (status message, vectorstore so far).
+    """
+    embeddings = get_embeddings()
+    save_dir = Path(VECTORSTORE_DIR) / f"session_{session_id}"
+    rebuild = vectorstore is None or read_vectorstore_manifest(save_dir) is None
+    delta = {"texts": [], "metadatas": [], "ids": [], "vectors": []}
+    errors = []
+    for chunks, files_done, files_total, errors in iter_document_chunks(file_paths):
+        if chunks:
+            texts = [doc.page_content for doc in chunks]
+            metadatas = [doc.metadata for doc in chunks]
+            ids = [str(uuid.uuid4()) for _ in chunks]
+            vectors = embeddings.embed_documents(texts)
+            if vectorstore is None:
+                vectorstore = FAISS.from_embeddings(list(zip(texts, vectors)), embeddings, metadatas=metadatas, ids=ids)
+            else:
+                vectorstore.add_embeddings(list(zip(texts, vectors)), metadatas=metadatas, ids=ids)
+            for key, values in (("texts", texts), ("metadatas", metadatas), ("ids", ids), ("vectors", vectors)):
+                delta[key].extend(values)
+        yield f"{temporary.STATUS_TEXTS['rag_process']} {files_done}/{files_total} files, {len(delta['ids'])} chunks", vectorstore
+    chunk_count = len(delta["ids"])
+    if vectorstore is not None and chunk_count:
+        if rebuild:
+            # New store, or one saved in the old save_local layout: write every row once
+            texts, metadatas, ids, vectors = export_vectorstore_rows(vectorstore)
+            append_vectorstore_delta(save_dir, texts, metadatas, ids, vectors, reset=True)
+        else:
+            append_vectorstore_delta(save_dir, delta["texts"], delta["metadatas"], delta["ids"], delta["vectors"])
+        context_injector.index_report = update_vectorstore_index(save_dir, vectorstore)
+    status = f"{temporary.STATUS_TEXTS['docs_processed']}: {chunk_count} chunks"
+    if chunk_count and context_injector.index_report:
+        status += f" ({context_injector.index_report})"
+    if errors:
+        status += f", failed: {', '.join(errors)}"
+    yield status, vectorstore
+
 def create_session_vectorstore(file_paths, session_id):
     if not file_paths:
+        shutil.rmtree(Path(VECTORSTORE_DIR) / f"session_{session_id}", ignore_errors=True)
         return None
-    docs = load_and_chunk_documents(file_paths)
-    embeddings = HuggingFaceEmbeddings(model_name="all-MiniLM-L6-v2")
+    vectorstore = None
     try:
-        vectorstore = FAISS.from_documents(docs, embeddings)
-        save_dir = Path(VECTORSTORE_DIR) / f"session_{session_id}"
-        save_dir.mkdir(parents=True, exist_ok=True)
-        vectorstore.save_local(str(save_dir))
+        for status, vectorstore in stream_session_vectorstore(file_paths, session_id):
+            print(f"Debug: {status}")
         return vectorstore
     except Exception as e:
         print(f"Error creating vectorstore: {e}")
@@ -340,14 +1003,30 @@ def delete_all_history_and_vectors():
     """
     history_dir = Path(HISTORY_DIR)
     vectorstore_dir = Path(VECTORSTORE_DIR)
+    cancel_session_restore()
     
-    # Delete all history JSON files
-    for file in history_dir.glob('*.json'):
+    # Delete all history JSON files and session journals
+    for file in list(history_dir.glob('*.json')) + list(history_dir.glob('*.jsonl')) + list(history_dir.glob('kv_*.state')):
         try:
             file.unlink()
             print(f"Deleted history file: {file}")
+            session_journals.pop(file.stem.replace('session_', ''), None)
         except Exception as e:
             print(f"Error deleting {file}: {e}")
+
+    # Empty the SQLite session store, if one has been created
+    if Path(temporary.SESSION_DB_FILE).exists():
+        with session_db_lock:
+            conn = get_session_db()
+            with conn:
+                conn.execute("DELETE FROM turns")
+                conn.execute("DELETE FROM sessions")
+        print(f"Cleared session store: {temporary.SESSION_DB_FILE}")
+
+    # Drop every session's blob references, then sweep the now unreferenced blobs
+    shutil.rmtree(Path(temporary.BLOB_DIR) / "sessions", ignore_errors=True)
+    (Path(temporary.BLOB_DIR) / "refs.json").unlink(missing_ok=True)
+    collect_blob_garbage()
     
     # Delete the entire vectorstore directory
     if vectorstore_dir.exists():
@@ -381,12 +1060,6 @@ def extract_links_with_descriptions(text):
             descriptions.append(f"{link}: Unable to generate description due to {str(e)}")
     return "\n".join(descriptions)
 
-def get_saved_sessions():
-    """Get list of saved session files sorted by modification time."""
-    history_dir = Path(HISTORY_DIR)  # Updated to use HISTORY_DIR
-    session_files = sorted(history_dir.glob("session_*.json"), key=lambda x: x.stat().st_mtime, reverse=True)
-    return [f.name for f in session_files]
-
 def update_setting(key, value):
     """Update a setting and return components requiring reload if necessary, with a confirmation message."""
     reload_required = False
@@ -488,6 +1161,38 @@ def load_config():
                     temporary.SESSION_LOG_HEIGHT = int(config["model_settings"]["session_log_height"])
                 if "input_lines" in config["model_settings"]:
                     temporary.INPUT_LINES = int(config["model_settings"]["input_lines"])
+                if "embedding_device" in config["model_settings"]:
+                    temporary.EMBEDDING_DEVICE = config["model_settings"]["embedding_device"]
+                if "embedding_threads" in config["model_settings"]:
+                    temporary.EMBEDDING_THREADS = int(config["model_settings"]["embedding_threads"])
+                if "vector_index_type" in config["model_settings"]:
+                    temporary.VECTOR_INDEX_TYPE = config["model_settings"]["vector_index_type"]
+                if "session_store" in config["model_settings"]:
+                    temporary.SESSION_STORE = config["model_settings"]["session_store"]
+                if "attach_inject_mode" in config["model_settings"]:
+                    temporary.ATTACH_INJECT_MODE = config["model_settings"]["attach_inject_mode"]
+                if "stream_mode" in config["model_settings"]:
+                    temporary.STREAM_MODE = config["model_settings"]["stream_mode"]
+                if "stream_frame_ms" in config["model_settings"]:
+                    temporary.STREAM_FRAME_MS = int(config["model_settings"]["stream_frame_ms"])
+                if "generation_timeout" in config["model_settings"]:
+                    temporary.GENERATION_TIMEOUT = int(config["model_settings"]["generation_timeout"])
+                if "kv_persist" in config["model_settings"]:
+                    temporary.KV_PERSIST = bool(config["model_settings"]["kv_persist"])
+                if "speculative_mode" in config["model_settings"]:
+                    temporary.SPECULATIVE_MODE = config["model_settings"]["speculative_mode"]
+                if "draft_model_name" in config["model_settings"]:
+                    temporary.DRAFT_MODEL_NAME = config["model_settings"]["draft_model_name"]
+                if "speculative_tokens" in config["model_settings"]:
+                    temporary.SPECULATIVE_TOKENS = int(config["model_settings"]["speculative_tokens"])
+                if "embedding_batch_size" in config["model_settings"]:
+                    temporary.EMBEDDING_BATCH_SIZE = int(config["model_settings"]["embedding_batch_size"])
+                if "ready_check" in config["model_settings"]:
+                    temporary.READY_CHECK = config["model_settings"]["ready_check"]
+                if "warmup_system_prompt" in config["model_settings"]:
+                    temporary.WARMUP_SYSTEM_PROMPT = bool(config["model_settings"]["warmup_system_prompt"])
+                if "countdown_prefill" in config["model_settings"]:
+                    temporary.COUNTDOWN_PREFILL = bool(config["model_settings"]["countdown_prefill"])
                 
                 if "backend_type" in config["backend_config"]:
                     temporary.BACKEND_TYPE = config["backend_config"]["backend_type"]
@@ -503,6 +1208,24 @@ def load_config():
                     temporary.MAX_HISTORY_SLOTS = temporary.HISTORY_SLOT_OPTIONS[0]
                 if temporary.SESSION_LOG_HEIGHT not in temporary.SESSION_LOG_HEIGHT_OPTIONS:
                     temporary.SESSION_LOG_HEIGHT = temporary.SESSION_LOG_HEIGHT_OPTIONS[0]
+                if temporary.VECTOR_INDEX_TYPE not in temporary.VECTOR_INDEX_OPTIONS:
+                    temporary.VECTOR_INDEX_TYPE = temporary.VECTOR_INDEX_OPTIONS[0]
+                if temporary.SESSION_STORE not in temporary.SESSION_STORE_OPTIONS:
+                    temporary.SESSION_STORE = temporary.SESSION_STORE_OPTIONS[0]
+                if temporary.ATTACH_INJECT_MODE not in temporary.ATTACH_INJECT_OPTIONS:
+                    temporary.ATTACH_INJECT_MODE = temporary.ATTACH_INJECT_OPTIONS[0]
+                if temporary.STREAM_MODE not in temporary.STREAM_MODE_OPTIONS:
+                    temporary.STREAM_MODE = temporary.STREAM_MODE_OPTIONS[0]
+                if temporary.GENERATION_TIMEOUT not in temporary.GENERATION_TIMEOUT_OPTIONS:
+                    temporary.GENERATION_TIMEOUT = temporary.GENERATION_TIMEOUT_OPTIONS[0]
+                if temporary.SPECULATIVE_MODE not in temporary.SPECULATIVE_OPTIONS:
+                    temporary.SPECULATIVE_MODE = temporary.SPECULATIVE_OPTIONS[0]
+                if temporary.SPECULATIVE_TOKENS not in temporary.SPECULATIVE_TOKEN_OPTIONS:
+                    temporary.SPECULATIVE_TOKENS = temporary.SPECULATIVE_TOKEN_OPTIONS[-2]
+                if temporary.DRAFT_MODEL_NAME not in temporary.AVAILABLE_MODELS:
+                    temporary.DRAFT_MODEL_NAME = "None"
+                if temporary.READY_CHECK not in temporary.READY_CHECK_OPTIONS:
+                    temporary.READY_CHECK = temporary.READY_CHECK_OPTIONS[0]
                 
                 if temporary.MODEL_NAME not in temporary.AVAILABLE_MODELS:
                     temporary.MODEL_NAME = "Browse_for_model_folder..." if not temporary.AVAILABLE_MODELS else temporary.AVAILABLE_MODELS[0]
@@ -540,7 +1263,23 @@ def save_config():
                 "max_history_slots": temporary.MAX_HISTORY_SLOTS,
                 "max_attach_slots": temporary.MAX_ATTACH_SLOTS,
                 "session_log_height": temporary.SESSION_LOG_HEIGHT,
-                "input_lines": temporary.INPUT_LINES
+                "input_lines": temporary.INPUT_LINES,
+                "ready_check": temporary.READY_CHECK,
+                "warmup_system_prompt": temporary.WARMUP_SYSTEM_PROMPT,
+                "countdown_prefill": temporary.COUNTDOWN_PREFILL,
+                "embedding_device": temporary.EMBEDDING_DEVICE,
+                "embedding_threads": temporary.EMBEDDING_THREADS,
+                "embedding_batch_size": temporary.EMBEDDING_BATCH_SIZE,
+                "vector_index_type": temporary.VECTOR_INDEX_TYPE,
+                "session_store": temporary.SESSION_STORE,
+                "attach_inject_mode": temporary.ATTACH_INJECT_MODE,
+                "stream_mode": temporary.STREAM_MODE,
+                "stream_frame_ms": temporary.STREAM_FRAME_MS,
+                "generation_timeout": temporary.GENERATION_TIMEOUT,
+                "kv_persist": temporary.KV_PERSIST,
+                "speculative_mode": temporary.SPECULATIVE_MODE,
+                "draft_model_name": temporary.DRAFT_MODEL_NAME,
+                "speculative_tokens": temporary.SPECULATIVE_TOKENS
             },
             "backend_config": {
                 "backend_type": temporary.BACKEND_TYPE,
@@ -566,6 +1305,22 @@ def save_config():
         print(f"Saved MAX_ATTACH_SLOTS: {temporary.MAX_ATTACH_SLOTS}")
         print(f"Saved SESSION_LOG_HEIGHT: {temporary.SESSION_LOG_HEIGHT}")
         print(f"Saved INPUT_LINES: {temporary.INPUT_LINES}")
+        print(f"Saved READY_CHECK: {temporary.READY_CHECK}")
+        print(f"Saved WARMUP_SYSTEM_PROMPT: {temporary.WARMUP_SYSTEM_PROMPT}")
+        print(f"Saved COUNTDOWN_PREFILL: {temporary.COUNTDOWN_PREFILL}")
+        print(f"Saved EMBEDDING_DEVICE: {temporary.EMBEDDING_DEVICE}")
+        print(f"Saved EMBEDDING_THREADS: {temporary.EMBEDDING_THREADS}")
+        print(f"Saved EMBEDDING_BATCH_SIZE: {temporary.EMBEDDING_BATCH_SIZE}")
+        print(f"Saved VECTOR_INDEX_TYPE: {temporary.VECTOR_INDEX_TYPE}")
+        print(f"Saved SESSION_STORE: {temporary.SESSION_STORE}")
+        print(f"Saved ATTACH_INJECT_MODE: {temporary.ATTACH_INJECT_MODE}")
+        print(f"Saved STREAM_MODE: {temporary.STREAM_MODE}")
+        print(f"Saved STREAM_FRAME_MS: {temporary.STREAM_FRAME_MS}")
+        print(f"Saved GENERATION_TIMEOUT: {temporary.GENERATION_TIMEOUT}")
+        print(f"Saved KV_PERSIST: {temporary.KV_PERSIST}")
+        print(f"Saved SPECULATIVE_MODE: {temporary.SPECULATIVE_MODE}")
+        print(f"Saved DRAFT_MODEL_NAME: {temporary.DRAFT_MODEL_NAME}")
+        print(f"Saved SPECULATIVE_TOKENS: {temporary.SPECULATIVE_TOKENS}")
         print(f"Saved BACKEND_TYPE: {temporary.BACKEND_TYPE}")
         print(f"Saved LLAMA_BIN_PATH: {temporary.LLAMA_BIN_PATH}")
         print("Settings saved successfully to persistent.json")